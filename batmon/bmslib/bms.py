@@ -1,6 +1,6 @@
 import math
 import time
-from copy import copy
+from operator import attrgetter
 from typing import Dict, List, Optional
 
 MIN_VALUE_EXPIRY = 20
@@ -24,6 +24,28 @@ class DeviceInfo:
 
 
 class BmsSample:
+    """
+    Samples are not modified after construction, so the sampler, BMS groups and the publish queue share them without
+    copying. multiply_current() returns a new sample.
+    """
+
+    __slots__ = (
+        "voltage",
+        "current",
+        "_power",
+        "balance_current",
+        "charge",
+        "capacity",
+        "soc",
+        "cycle_capacity",
+        "num_cycles",
+        "temperatures",
+        "mos_temperature",
+        "switches",
+        "uptime",
+        "timestamp",
+    )
+
     def __init__(
         self,
         voltage,
@@ -91,19 +113,37 @@ class BmsSample:
         return (self.voltage * self.current) if math.isnan(self._power) else self._power
 
     def __str__(self):
-        # noinspection PyStringFormat
-        return (
-            "BmsSampl(%(soc).1f%%,U=%(voltage).1fV,I=%(current).2fA,P=%(power).0fW,q=%(charge).1fAh/%(capacity).0f,mos=%(mos_temperature).1f°C)"
-            % {**self.__dict__, "power": self.power}
+        return "BmsSampl(%.1f%%,U=%.1fV,I=%.2fA,P=%.0fW,q=%.1fAh/%.0f,mos=%.1f°C)" % (
+            self.soc,
+            self.voltage,
+            self.current,
+            self.power,
+            self.charge,
+            self.capacity,
+            self.mos_temperature,
         )
 
+    def __copy__(self):
+        res = BmsSample.__new__(BmsSample)
+        for name, value in zip(self.__slots__, _slot_values(self)):
+            setattr(res, name, value)
+        return res
+
     def invert_current(self):
         return self.multiply_current(-1)
 
     def multiply_current(self, x):
-        res = copy(self)
+        """
+        :return: a sample with current and power multiplied by x, or this sample if x is 1
+        """
+        if x == 1:
+            return self
+        res = self.__copy__()
         if res.current != 0:  # prevent -0 values
             res.current *= x
         if not math.isnan(res._power) and res._power != 0:
             res._power *= x
         return res
+
+
+_slot_values = attrgetter(*BmsSample.__slots__)
@@ -2,25 +2,66 @@ import asyncio
 import re
 import subprocess
 import time
-from typing import Callable, List, Union
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set, Union
 
-import backoff
 from bleak import BleakClient, BleakScanner
+from bleak.backends.device import BLEDevice
 
-from . import FuturesPool
+from .correlator import RequestCorrelator
 from .bms import BmsSample, DeviceInfo
+from .frame import FrameTrace
 from .util import get_logger
 
 
-@backoff.on_exception(backoff.expo, Exception, max_time=10, logger=None)
-async def bt_discovery(logger):
-    logger.info("BT Discovery:")
-    devices = await BleakScanner.discover()
-    if not devices:
-        logger.info(" - no devices found - ")
-    for d in devices:
-        logger.info("BT Device   %s   address=%s", d.name, d.address)
-    return devices
+async def bt_discovery_stream(
+    logger, wanted: Set[str], timeout: float = 10.0, adapter=None
+) -> AsyncIterator[BLEDevice]:
+    """
+    Scan for bluetooth devices and yield each device as soon as it is seen (again if its name shows up later).
+    Stops when all `wanted` addresses or names were seen or after `timeout` seconds.
+
+    :param logger:
+    :param wanted: device addresses or names to look for (case-insensitive)
+    :param timeout: scan deadline in seconds
+    :param adapter: bluetooth adapter (hci0, hci1, ..), None for the default adapter
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    logger.info(
+        "BT Discovery%s, looking for %s:", f" ({adapter})" if adapter else "", wanted
+    )
+    remaining = set(w.strip().lower() for w in wanted)
+    seen: Dict[str, Optional[str]] = {}
+    deadline = loop.time() + timeout
+
+    scanner = SharedScanner.get(adapter)
+    listener = queue.put_nowait
+    scanner.add_listener(listener)
+    # devices the running scanner has seen already
+    for dev in list(scanner.devices.values()):
+        if time.time() - dev["time"] <= SEEN_MAX_AGE:
+            queue.put_nowait(dev["device"])
+    try:
+        await scanner.start()
+        while remaining:
+            try:
+                device = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if device.address in seen and (seen[device.address] or not device.name):
+                continue
+            seen[device.address] = device.name
+            logger.info("BT Device   %s   address=%s", device.name, device.address)
+            remaining.discard(device.address.lower())
+            remaining.discard((device.name or "").strip().lower())
+            yield device
+    finally:
+        scanner.remove_listener(listener)
+
+    if remaining:
+        logger.info("Discovery timeout, not found: %s", remaining)
 
 
 def bleak_version():
@@ -55,7 +96,119 @@ def bt_power(on):
         raise Exception("error with cmd %s: %s" % (cmd, bytes.decode(err, "utf-8")))
 
 
+# a device seen by the scanner within this many seconds is considered present
+SEEN_MAX_AGE = 30
+
+
+class SharedScanner:
+    """
+    One long-lived bluetooth scanner per adapter, started once (see main) and running for the process lifetime. It
+    keeps a presence table of the devices it has seen, with RSSI and time last seen, which BtBms.connect() looks up
+    instead of starting a scan of its own. Concurrent scans on an adapter are serialized or rejected by BlueZ.
+    """
+
+    _instances: Dict[Optional[str], "SharedScanner"] = {}
+
+    @classmethod
+    def get(cls, adapter: Optional[str] = None) -> "SharedScanner":
+        if adapter not in cls._instances:
+            cls._instances[adapter] = SharedScanner(adapter)
+        return cls._instances[adapter]
+
+    @classmethod
+    async def stop_all(cls):
+        for scanner in cls._instances.values():
+            await scanner.stop()
+
+    def __init__(self, adapter: Optional[str] = None):
+        self.adapter = adapter
+        self.devices: Dict[str, dict] = {}  # upper case address -> dict(device=, name=, rssi=, time=)
+        self._listeners: List[Callable[[BLEDevice], None]] = []
+        self._scanner: Optional[BleakScanner] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def running(self) -> bool:
+        return self._scanner is not None
+
+    def _on_detection(self, device: BLEDevice, adv):
+        key = device.address.upper()
+        prev = self.devices.get(key)
+        self.devices[key] = dict(
+            device=device,
+            name=device.name or (prev and prev["name"]),
+            rssi=getattr(adv, "rssi", None),
+            time=time.time(),
+        )
+        for listener in self._listeners:
+            listener(device)
+
+    def seen(self, address: str, max_age: float) -> bool:
+        """
+        :return: True if the device was seen within the last max_age seconds
+        """
+        dev = self.devices.get(address.upper())
+        return bool(dev) and (time.time() - dev["time"]) <= max_age
+
+    async def wait_seen(self, address: str, max_age: float, timeout: float) -> bool:
+        """
+        Wait until the device is seen, if it wasn't seen within the last max_age seconds.
+        :return: False if the device was not seen within timeout seconds
+        """
+        if self.seen(address, max_age):
+            return True
+        key = address.upper()
+        found = asyncio.get_running_loop().create_future()
+
+        def listener(device: BLEDevice):
+            if device.address.upper() == key and not found.done():
+                found.set_result(True)
+
+        self.add_listener(listener)
+        try:
+            return await asyncio.wait_for(found, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.remove_listener(listener)
+
+    def add_listener(self, callback: Callable[[BLEDevice], None]):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[BLEDevice], None]):
+        self._listeners.remove(callback)
+
+    async def start(self):
+        """
+        Start scanning, if not already running
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._scanner:
+                return
+            kwargs = {}
+            if self.adapter:
+                kwargs["adapter"] = self.adapter
+            scanner = BleakScanner(detection_callback=self._on_detection, **kwargs)
+            get_logger().info("starting scanner (%s)", self.adapter or "default adapter")
+            # e.g. org.bluez.Error.InProgress, the next start() tries again
+            await scanner.start()
+            self._scanner = scanner
+
+    async def stop(self):
+        if self._lock is None:
+            return
+        async with self._lock:
+            if self._scanner:
+                scanner, self._scanner = self._scanner, None
+                await scanner.stop()
+
+
 class BtBms:
+    # requests written to the BMS and not yet answered, pipelined commands count as one
+    MAX_PENDING_REQUESTS = 4
+
     def __init__(
         self,
         address: str,
@@ -70,9 +223,15 @@ class BtBms:
         self.keep_alive = keep_alive
         self.verbose_log = verbose_log
         self.logger = get_logger(verbose_log)
-        self._fetch_futures = FuturesPool()
+        self._requests = RequestCorrelator(max_pending=self.MAX_PENDING_REQUESTS)
         self._psk = psk
         self._connect_time = 0
+        self._adapter = adapter
+        self.trace = FrameTrace()
+        # set by the sampler, whether fetch() should also read cell voltages and temperatures, if the BMS can
+        self.want_cells = True
+        if verbose_log:
+            self.trace.enable()
 
         if address.startswith("test_"):
             from batmon.bmslib.dummy import BleakDummyClient
@@ -92,7 +251,6 @@ class BtBms:
                         bleak_version(),
                     )
 
-            self._adapter = adapter
             if adapter:  # hci0, hci1 (BT adapter hardware)
                 kwargs["adapter"] = adapter
 
@@ -136,9 +294,9 @@ class BtBms:
             )
 
         try:
-            self._fetch_futures.clear()
+            self._requests.cancel_all()
         except Exception as e:
-            self.logger.warning("error clearing futures pool: %s", str(e) or type(e))
+            self.logger.warning("error cancelling pending requests: %s", str(e) or type(e))
 
     async def _connect_client(self, timeout):
         await self.client.connect(timeout=timeout)
@@ -172,42 +330,56 @@ class BtBms:
     def is_connected(self):
         return self.client.is_connected
 
+    @property
+    def adapter(self) -> Optional[str]:
+        """
+        :return: name of the bluetooth adapter (hci0, hci1, ..) or None for the default adapter
+        """
+        return self._adapter
+
     async def connect(self, timeout=20):
         """
-        Establish a BLE connection
+        Establish a BLE connection. If the shared scanner of the adapter is running, wait until it has seen the
+        device first.
         :param timeout:
         :return:
         """
+        scanner = SharedScanner.get(self._adapter)
+        if isinstance(self.client, BleakClient) and scanner.running:
+            if not await scanner.wait_seen(self.client.address, max_age=SEEN_MAX_AGE, timeout=timeout / 2):
+                raise Exception(
+                    "Device %s not seen by the scanner. Make sure it in range and is not being controled by "
+                    "another application." % self.client.address
+                )
         await self._connect_client(timeout=timeout)
 
     async def _connect_with_scanner(self, timeout=20):
         """
-        Starts a bluetooth discovery and tries to establish a BLE connection with back off.
-         This fixes connection errors for some BMS (jikong). Use instead of connect().
+        Tries to establish a BLE connection with back off, while the shared scanner of the adapter sees the device.
+        This fixes connection errors for some BMS (jikong). Use instead of connect().
 
         :param timeout:
         :return:
         """
-        import bleak
-
-        scanner_kw = {}
-        if self._adapter:
-            scanner_kw["adapter"] = self._adapter
-        scanner = bleak.BleakScanner(**scanner_kw)
-        self.logger.debug("starting scan")
+        scanner = SharedScanner.get(self._adapter)
+        # normally started by main, for the process lifetime
         await scanner.start()
 
         attempt = 1
         while True:
             try:
-                discovered = set(b.address for b in scanner.discovered_devices)
-                if self.client.address not in discovered:
+                if not await scanner.wait_seen(self.client.address, max_age=SEEN_MAX_AGE, timeout=2):
                     raise Exception(
                         "Device %s not discovered. Make sure it in range and is not being controled by "
-                        "another application. (%s)" % (self.client.address, discovered)
+                        "another application. (%s)"
+                        % (self.client.address, set(scanner.devices.keys()))
                     )
 
-                self.logger.debug("connect attempt %d", attempt)
+                self.logger.debug(
+                    "connect attempt %d (rssi %s)",
+                    attempt,
+                    scanner.devices[self.client.address.upper()]["rssi"],
+                )
                 await self._connect_client(timeout=timeout / 2)
                 break
             except Exception as e:
@@ -217,14 +389,11 @@ class BtBms:
                     await asyncio.sleep(0.2 * (1.5**attempt))
                     attempt += 1
                 else:
-                    await scanner.stop()
                     raise
 
-        await scanner.stop()
-
     async def disconnect(self):
         await self.client.disconnect()
-        self._fetch_futures.clear()
+        self._requests.cancel_all()
 
     async def fetch_device_info(self) -> DeviceInfo:
         """
@@ -262,6 +431,13 @@ class BtBms:
     async def subscribe_voltages(self, callback: Callable[[List[int]], None]):
         raise NotImplementedError()
 
+    async def subscribe_current(self, callback: Callable[[float, float], None]):
+        """
+        Subscribe to voltage and current readings the BMS sends more often than samples are taken, for energy
+        metering. The callback receives voltage in V and current in A (positive=discharging).
+        """
+        raise NotImplementedError()
+
     async def set_switch(self, switch: str, state: bool):
         """
         Send a switch command to the BMS to control a physical switch, usually a MOSFET or relay.
@@ -326,3 +502,58 @@ async def enumerate_services(client: BleakClient, logger):
                     logger.info(f"\t\t[Descriptor] {descriptor}) | Value: {value}")
                 except Exception as e:
                     logger.error(f"\t\t[Descriptor] {descriptor}) | Value: {e}")
+
+
+def test_shared_scanner():
+    global BleakScanner
+
+    class FailingScanner:
+        num_started = 0
+
+        def __init__(self, detection_callback, **kwargs):
+            pass
+
+        async def start(self):
+            FailingScanner.num_started += 1
+            if FailingScanner.num_started == 1:
+                raise Exception("org.bluez.Error.InProgress")
+
+        async def stop(self):
+            pass
+
+    class Device:
+        def __init__(self, address, name):
+            self.address = address
+            self.name = name
+
+    async def run():
+        scanner = SharedScanner("test_adapter")
+        try:
+            await scanner.start()
+            assert False
+        except Exception as e:
+            assert "InProgress" in str(e)
+        assert not scanner.running
+
+        # started once, for all users
+        await scanner.start()
+        await scanner.start()
+        assert scanner.running and FailingScanner.num_started == 2
+
+        # presence table, addresses are case-insensitive
+        assert not await scanner.wait_seen("c8:47:8c:00:00:01", max_age=30, timeout=0.01)
+        device = Device("C8:47:8C:00:00:01", "bms")
+        asyncio.get_running_loop().call_later(0.01, scanner._on_detection, device, None)
+        assert await scanner.wait_seen("c8:47:8c:00:00:01", max_age=30, timeout=1)
+        assert scanner.seen("C8:47:8C:00:00:01", max_age=30)
+        assert not scanner.seen("C8:47:8C:00:00:01", max_age=-1)
+        assert not scanner._listeners
+
+        await scanner.stop()
+        assert not scanner.running
+
+    bleak_scanner, BleakScanner = BleakScanner, FailingScanner
+    try:
+        asyncio.run(run())
+    finally:
+        BleakScanner = bleak_scanner
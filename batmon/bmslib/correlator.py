@@ -0,0 +1,184 @@
+import asyncio
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+Key = Union[str, int]
+KeyType = Union[Key, Tuple[Key, ...]]
+
+
+class RequestCorrelator:
+    """
+    Correlate BLE responses with pending requests by key (usually the response type or command byte).
+
+    Any number of waiters can wait for the same key and a response is delivered to all of them, so a fetch and a
+    concurrent set_switch can both wait for the same frame. A request can wait for several keys at once, for pipelined
+    commands. At most `max_pending` requests are outstanding, further requests wait until one completes.
+    cancel_all() fails all waiters with a ConnectionError, e.g. on disconnect.
+
+        async with correlator.request((0x03, 0x04)) as req:
+            await client.write_gatt_char(...)
+            resp_03, resp_04 = await req.wait(timeout)
+
+    Waiters are registered before the request is written, so a response arriving quickly is not missed.
+    """
+
+    def __init__(self, max_pending: Optional[int] = None):
+        self._waiters: Dict[Key, List[asyncio.Future]] = defaultdict(list)
+        self.max_pending = max_pending
+        self._slots: Optional[asyncio.Semaphore] = None  # created in the event loop
+        self.num_timeouts = 0
+
+    def request(self, keys: KeyType) -> "PendingRequest":
+        return PendingRequest(self, keys)
+
+    def set_result(self, key: Key, value: Any) -> int:
+        """
+        Deliver a response to all waiters of `key`
+        :return: number of waiters the response was delivered to
+        """
+        waiters = self._waiters.pop(key, None)
+        if not waiters:
+            return 0
+        n = 0
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(value)
+                n += 1
+        return n
+
+    def cancel_all(self, reason="disconnected"):
+        waiters, self._waiters = self._waiters, defaultdict(list)
+        for futures in waiters.values():
+            for fut in futures:
+                if not fut.done():
+                    fut.set_exception(ConnectionError(reason))
+
+    def num_waiters(self, key: Key) -> int:
+        return len(self._waiters.get(key, ()))
+
+    async def _acquire_slot(self):
+        if self.max_pending:
+            if self._slots is None:
+                self._slots = asyncio.Semaphore(self.max_pending)
+            await self._slots.acquire()
+
+    def _release_slot(self):
+        if self._slots:
+            self._slots.release()
+
+    def _add(self, key: Key) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[key].append(fut)
+        return fut
+
+    def _discard(self, key: Key, fut: asyncio.Future):
+        waiters = self._waiters.get(key)
+        if waiters:
+            try:
+                waiters.remove(fut)
+            except ValueError:
+                pass
+            if not waiters:
+                del self._waiters[key]
+        if fut.done() and not fut.cancelled():
+            fut.exception()  # mark as retrieved
+
+    def __len__(self):
+        return sum(map(len, self._waiters.values()))
+
+
+class PendingRequest:
+    def __init__(self, correlator: RequestCorrelator, keys: KeyType):
+        self.correlator = correlator
+        self.keys = keys
+        self._futures: List[asyncio.Future] = []
+
+    async def __aenter__(self):
+        await self.correlator._acquire_slot()
+        keys = self.keys if isinstance(self.keys, tuple) else (self.keys,)
+        self._futures = [self.correlator._add(k) for k in keys]
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        keys = self.keys if isinstance(self.keys, tuple) else (self.keys,)
+        for key, fut in zip(keys, self._futures):
+            self.correlator._discard(key, fut)
+        self.correlator._release_slot()
+
+    async def wait(self, timeout):
+        """
+        :return: the response, or a list of responses if the request was made with a tuple of keys
+        """
+        if isinstance(self.keys, tuple):
+            fut = asyncio.gather(*self._futures)
+        else:
+            fut = self._futures[0]
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            self.correlator.num_timeouts += 1
+            raise
+
+
+def test_request_correlator():
+    async def run():
+        c = RequestCorrelator(max_pending=2)
+
+        # several waiters, broadcast
+        async def waiter(key):
+            async with c.request(key) as req:
+                return await req.wait(1)
+
+        tasks = [asyncio.ensure_future(waiter(0x02)) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert c.num_waiters(0x02) == 2
+        assert c.set_result(0x02, b"a") == 2
+        assert await asyncio.gather(*tasks) == [b"a", b"a"]
+        assert len(c) == 0
+
+        # pipelined keys, responses in any order
+        async with c.request((0x03, 0x04)) as req:
+            c.set_result(0x04, 4)
+            c.set_result(0x03, 3)
+            assert await req.wait(1) == [3, 4]
+
+        # timeout
+        try:
+            async with c.request(0x05) as req:
+                await req.wait(0.01)
+            assert False
+        except asyncio.TimeoutError:
+            pass
+        assert c.num_timeouts == 1 and len(c) == 0
+
+        # cancel on disconnect, before and while waiting
+        async with c.request(0x06):
+            c.cancel_all()
+        task = asyncio.ensure_future(waiter(0x06))
+        await asyncio.sleep(0)
+        c.cancel_all()
+        try:
+            await task
+            assert False
+        except ConnectionError:
+            pass
+        assert len(c) == 0
+
+        # depth limit
+        tasks = [asyncio.ensure_future(waiter(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        assert len(c) == 2
+        assert not c.num_waiters(2)
+        c.set_result(0, 0)
+        while not c.num_waiters(2):
+            await asyncio.sleep(0)
+        assert len(c) == 2
+        c.set_result(1, 1)
+        c.set_result(2, 2)
+        assert await asyncio.gather(*tasks) == [0, 1, 2]
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_request_correlator()
@@ -7,10 +7,11 @@ https://github.com/esphome/esphome/tree/dev/esphome/components/daly_bms
 """
 import asyncio
 import struct
-from typing import Dict
+from typing import Dict, List, Optional
 
 from .bms import BmsSample
 from .bt import BtBms
+from .frame import FrameTrace
 
 
 def calc_crc(message_bytes):
@@ -30,6 +31,9 @@ class DalyBt(BtBms):
         # self._num_cells = 0
         self._states = None
         self._last_response = None
+        # cell voltages and temperatures read along with the last sample
+        self._voltages: Optional[List[int]] = None
+        self._temperatures: Optional[List[float]] = None
 
     async def get_states_cached(self, key):
         if not self._states:
@@ -44,7 +48,8 @@ class DalyBt(BtBms):
         responses = [data[i : i + RESP_LEN] for i in range(0, len(data), RESP_LEN)]
 
         for response_bytes in responses:
-            self.logger.debug("daly resp: %s", response_bytes)
+            if self.trace.enabled:
+                self.trace.record(FrameTrace.RX, response_bytes)
 
             command = response_bytes[2]
             response_bytes = response_bytes[4:-1]
@@ -64,7 +69,7 @@ class DalyBt(BtBms):
                     continue
 
             self._last_response = response_bytes
-            self._fetch_futures.set_result(command, response_bytes)
+            self._requests.set_result(command, response_bytes)
 
     async def connect(self, timeout=10, **kwargs):
         try:
@@ -111,26 +116,43 @@ class DalyBt(BtBms):
         await super().disconnect()
 
     async def _q(self, command: int, num_responses: int = 1):
-        msg = self.daly_command_message(command)
-        if num_responses > 1:
-            self._fetch_nr[command] = [None] * num_responses
-        else:
-            self._fetch_nr.pop(command, None)
+        resp = await self._q_pipelined({command: num_responses})
+        return resp[command]
 
-        with self._fetch_futures.acquire(command):
-            self.logger.debug("daly send: %s", msg)
-            await self.client.write_gatt_char(self.UUID_TX, msg)
+    async def _q_pipelined(self, requests: Dict[int, int]):
+        """
+        Write several commands back-to-back and wait for all responses, which _notification_callback routes by their
+        command byte. This takes about one BLE round trip, regardless of the number of commands.
+        :param requests: command -> number of response frames
+        :return: command -> response
+        """
+        commands = tuple(requests.keys())
+        for command, num_responses in requests.items():
+            if num_responses > 1:
+                self._fetch_nr[command] = [None] * num_responses
+            else:
+                self._fetch_nr.pop(command, None)
+
+        async with self._requests.request(commands) as req:
+            for command in commands:
+                msg = self.daly_command_message(command)
+                self.logger.debug("daly send: %s", msg)
+                await self.client.write_gatt_char(self.UUID_TX, msg)
 
             try:
-                sample = await self._fetch_futures.wait_for(command, self.TIMEOUT)
-            except TimeoutError:
-                n_recv = num_responses - self._fetch_nr[command].count(None)
+                responses = await req.wait(self.TIMEOUT)
+            except asyncio.TimeoutError:
+                n_recv = ", ".join(
+                    "%02x:%d/%d" % (command, num_responses - self._fetch_nr[command].count(None), num_responses)
+                    for command, num_responses in requests.items()
+                    if num_responses > 1
+                )
                 raise TimeoutError(
-                    "timeout awaiting result %02x, got %d/%d responses"
-                    % (command, n_recv, num_responses)
+                    "timeout awaiting result %s (multi-frame responses %s)"
+                    % (" ".join("%02x" % c for c in commands), n_recv or "-")
                 )
 
-            return sample
+        return dict(zip(commands, responses))
 
     async def set_switch(self, switch: str, state: bool):
         fet_addr = dict(discharge=0xD9, charge=0xDA)
@@ -138,21 +160,44 @@ class DalyBt(BtBms):
         await self.client.write_gatt_char(self.UUID_TX, msg)
 
     async def fetch(self) -> BmsSample:
-        status = await self._fetch_status()
-        sample = await self.fetch_soc(
+        requests = {0x93: 1, 0x90: 1}
+        self._voltages = self._temperatures = None
+        if not self._states:
+            requests[0x94] = 1
+        elif self.want_cells:
+            # read cell voltages and temperatures in the same round trip, for the following fetch_voltages() and
+            # fetch_temperatures()
+            requests[0x95] = self._num_voltage_responses(self._states["num_cells"])
+            requests[0x96] = self._num_temperature_responses(self._states["num_temps"])
+
+        resp = await self._q_pipelined(requests)
+
+        if 0x94 in resp:
+            self._states = self._parse_states(resp[0x94])
+            self.logger.info("got daly states: %s", self._states)
+
+        if 0x95 in resp:
+            self._voltages = self._parse_voltages(resp[0x95], self._states["num_cells"])
+            self._temperatures = self._parse_temperatures(resp[0x96], self._states["num_temps"])
+
+        status = self._parse_status(resp[0x93])
+        return self._parse_soc(
+            resp[0x90],
             sample_kwargs=dict(
                 charge=status["capacity_ah"],
                 switches=dict(
                     charge=bool(status["charging_mosfet"]),
                     discharge=bool(status["discharging_mosfet"]),
                 ),
-            )
+            ),
         )
-        return sample
 
     async def fetch_soc(self, sample_kwargs=None):
         resp = await self._q(0x90)
+        await self.get_states_cached("num_cycles")
+        return self._parse_soc(resp, sample_kwargs or {})
 
+    def _parse_soc(self, resp, sample_kwargs):
         parts = struct.unpack(">h h h h", resp)
 
         # x_v =  parts[1] / 10,  # always 0 "x_voltage", acquisition
@@ -161,14 +206,16 @@ class DalyBt(BtBms):
             voltage=parts[0] / 10,
             current=(parts[2] - 30000) / 10,  # negative=charging, positive=discharging
             soc=parts[3] / 10,
-            num_cycles=await self.get_states_cached("num_cycles"),
+            num_cycles=self._states.get("num_cycles"),
             **sample_kwargs,
         )
         return sample
 
     async def _fetch_status(self):
-        response_data = await self._q(0x93)
+        return self._parse_status(await self._q(0x93))
 
+    @staticmethod
+    def _parse_status(response_data):
         parts = struct.unpack(">b ? ? B l", response_data)
 
         if parts[0] == 0:
@@ -187,9 +234,10 @@ class DalyBt(BtBms):
         }
 
     async def fetch_states(self):
+        return self._parse_states(await self._q(0x94))
 
-        response_data = await self._q(0x94)
-
+    @staticmethod
+    def _parse_states(response_data):
         parts = struct.unpack(">b b ? ? b h x", response_data)
 
         state_bits = bin(parts[4])[2:]
@@ -211,15 +259,34 @@ class DalyBt(BtBms):
         }
         return data
 
+    @staticmethod
+    def _num_voltage_responses(num_cells):
+        assert isinstance(num_cells, int) and 0 < num_cells <= 32, (
+            "num_cells %s outside range" % num_cells
+        )
+        return round(num_cells / 3 + 0.5)  # bms sends tuples of 3 (ceil)
+
+    @staticmethod
+    def _num_temperature_responses(num_sensors):
+        assert isinstance(num_sensors, int) and 0 < num_sensors <= 32, (
+            "num_sensors %s outside range" % num_sensors
+        )
+        return round(num_sensors / 7 + 0.5)  # bms sends tuples of 7 (ceil)
+
     async def fetch_voltages(self, num_cells=0):
         if not num_cells:
+            if self._voltages is not None:
+                voltages, self._voltages = self._voltages, None
+                return voltages
             num_cells = await self.get_states_cached("num_cells")
-            assert isinstance(num_cells, int) and 0 < num_cells <= 32, (
-                "num_cells %s outside range" % num_cells
-            )
 
-        num_resp = round(num_cells / 3 + 0.5)  # bms sends tuples of 3 (ceil)
-        resp = await self._q(0x95, num_responses=num_resp)
+        resp = await self._q(0x95, num_responses=self._num_voltage_responses(num_cells))
+        return self._parse_voltages(resp, num_cells)
+
+    def _parse_voltages(self, resp, num_cells):
+        num_resp = self._num_voltage_responses(num_cells)
+        if num_resp == 1:
+            resp = [resp]
         voltages = []
         for i in range(num_resp):
             v = struct.unpack(">b 3h x", resp[i])
@@ -229,16 +296,19 @@ class DalyBt(BtBms):
 
     async def fetch_temperatures(self, num_sensors=0):
         if not num_sensors:
+            if self._temperatures is not None:
+                temperatures, self._temperatures = self._temperatures, None
+                return temperatures
             num_sensors = await self.get_states_cached("num_temps")
-            assert isinstance(num_sensors, int) and 0 < num_sensors <= 32, (
-                "num_sensors %s outside range" % num_sensors
-            )
 
-        temperatures = []
-        n_resp = round(num_sensors / 7 + 0.5)  # bms sends tuples of 7 (ceil)
-        resp = await self._q(0x96, num_responses=n_resp)
+        resp = await self._q(0x96, num_responses=self._num_temperature_responses(num_sensors))
+        return self._parse_temperatures(resp, num_sensors)
+
+    def _parse_temperatures(self, resp, num_sensors):
+        n_resp = self._num_temperature_responses(num_sensors)
         if n_resp == 1:
             resp = [resp]
+        temperatures = []
         for i in range(n_resp):
             v = struct.unpack(">b 7b", resp[i])
             assert v[0] == i + 1, "out-of-order frame %s != #%s" % (v, i + 1)
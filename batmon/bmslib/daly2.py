@@ -1,164 +1,217 @@
 """
-Other Daly protocol
+Daly BMS with the newer Modbus-style protocol
+
+A single read of the register block 0x00-0x3D returns cell voltages, temperatures, voltage, current and SOC, so a
+sample takes one request instead of the command-per-field exchange of the legacy Daly protocol (see daly.py).
+
+Registers (16 bit, big endian):
+0x00-0x1F cell voltages (mV)
+0x20-0x27 temperatures (°C + 40)
+0x28      voltage (0.1 V)
+0x29      current (0.1 A, offset 30000, negative=charging)
+0x2A      SOC (0.1 %)
+0x30      remaining charge (0.1 Ah)
+0x31      number of cells
+0x32      number of temperature sensors
+0x33      number of cycles
 
 References
 - https://github.com/roccotsi2/esp32-smart-bms-simulation
-
--  https://github.com/tomatensaus/python-daly-bms
+- https://github.com/tomatensaus/python-daly-bms
 
 """
 import asyncio
-
-from batmon.bmslib import FuturesPool
+import struct
+from typing import Optional, Tuple
 
 from .bms import BmsSample
 from .bt import BtBms
+from .frame import FrameAssembler, FrameTrace
+
+MODBUS_ADDRESS = 0xD2
+MODBUS_READ = 0x03
+
+NUM_REGISTERS = 0x3E
+REGISTERS = struct.Struct(">%dH" % NUM_REGISTERS)
+
+REG_CELLS = 0x00
+REG_TEMPS = 0x20
+REG_VOLTAGE = 0x28
+REG_CURRENT = 0x29
+REG_SOC = 0x2A
+REG_CHARGE = 0x30
+REG_NUM_CELLS = 0x31
+REG_NUM_TEMPS = 0x32
+REG_NUM_CYCLES = 0x33
+
+MAX_CELLS = REG_TEMPS - REG_CELLS
+MAX_TEMPS = REG_VOLTAGE - REG_TEMPS
+
+# address, function, byte count, registers, crc
+RESPONSE_HEADER = bytes([MODBUS_ADDRESS, MODBUS_READ, NUM_REGISTERS * 2])
+RESPONSE_SIZE = len(RESPONSE_HEADER) + REGISTERS.size + 2
 
 
-def _daly_command(command: int):
-    return bytes([0xDD, 0xA5, command, 0x00, 0xFF, 0xFF - (command - 1), 0x77])
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
 
 
-class JbdBt(BtBms):
+_CRC16_TABLE = _crc16_table()
+
+
+def crc16_modbus(data) -> int:
+    crc = 0xFFFF
+    for b in data:
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ b) & 0xFF]
+    return crc
+
+
+def _modbus_read_command(register: int, count: int):
+    frame = struct.pack(">BBHH", MODBUS_ADDRESS, MODBUS_READ, register, count)
+    return frame + struct.pack("<H", crc16_modbus(frame))
+
+
+class Daly2Bt(BtBms):
     UUID_RX = "0000fff1-0000-1000-8000-00805f9b34fb"
     UUID_TX = "0000fff2-0000-1000-8000-00805f9b34fb"
     TIMEOUT = 8
 
     def __init__(self, address, **kwargs):
         super().__init__(address, **kwargs)
-        self._buffer = bytearray()
-        self._fetch_futures = FuturesPool()
-        self._switches = None
-
-    def _notification_handler(self, sender, data):
-        self.logger.debug("ble data frame %s", data)
-        self._buffer += data
+        if kwargs.get("psk"):
+            self.logger.warning("Daly usually does not use a pairing PIN")
+        self._frames = FrameAssembler(
+            RESPONSE_HEADER,
+            frame_size=RESPONSE_SIZE,
+            check=self._frame_crc_check,
+            logger=self.logger,
+            trace=self.trace,
+        )
+        self._command = _modbus_read_command(0x00, NUM_REGISTERS)
+        self._last_response = None
+        # registers of the last read, for fetch_voltages()
+        self._registers: Optional[Tuple[int, ...]] = None
 
-        if self._buffer.endswith(b"w"):
-            command = self._buffer[1]
-            buf = self._buffer[:]
-            self._buffer.clear()
+    @staticmethod
+    def _frame_crc_check(frame: memoryview):
+        n = RESPONSE_SIZE - 2
+        return crc16_modbus(frame[:n]) == int.from_bytes(frame[n:RESPONSE_SIZE], "little")
 
-            # print(command, 'buffer endswith w', self._buffer)
-            self._fetch_futures.set_result(comand, buf)
+    def _notification_handler(self, sender, data):
+        if self.trace.enabled:
+            self.trace.record(FrameTrace.RX, data)
+
+        frame = self._frames.feed(data)
+        if frame is not None:
+            self._last_response = bytes(frame[:RESPONSE_SIZE])
+            self._requests.set_result(MODBUS_READ, self._last_response)
+
+    async def connect(self, timeout=10, **kwargs):
+        try:
+            await super().connect(timeout=timeout)
+        except Exception as e:
+            self.logger.info(
+                "normal connect failed (%s), connecting with scanner", str(e) or type(e)
+            )
+            await self._connect_with_scanner(timeout=timeout)
 
-    async def connect(self, **kwargs):
-        await super().connect(**kwargs)
         await self.client.start_notify(self.UUID_RX, self._notification_handler)
 
     async def disconnect(self):
         await self.client.stop_notify(self.UUID_RX)
-        self._fetch_futures.clear()
         await super().disconnect()
 
-    async def _q(self, cmd):
-        with self._fetch_futures.acquire(cmd):
-            await self.client.write_gatt_char(self.UUID_TX, data=_jbd_command(cmd))
-            return await self._fetch_futures.wait_for(cmd, self.TIMEOUT)
+    async def _read_registers(self) -> Tuple[int, ...]:
+        async with self._requests.request(MODBUS_READ) as req:
+            await self.client.write_gatt_char(self.UUID_TX, data=self._command)
+            buf = await req.wait(self.TIMEOUT)
+        self._registers = REGISTERS.unpack_from(buf, len(RESPONSE_HEADER))
+        return self._registers
 
     async def fetch(self) -> BmsSample:
-        # binary reading
-        #  https://github.com/roccotsi2/esp32-smart-bms-simulation
-
-        buf = await self._q(cmd=bytes.fromhex("D2 03 00 00 00 3E D7 B9"))
-        buf = buf[4:]
-
-        num_cell = int.from_bytes(buf[21:22], "big")
-        num_temp = int.from_bytes(buf[22:23], "big")
-
-        mos_byte = int.from_bytes(buf[20:21], "big")
-
-        sample = BmsSample(
-            voltage=int.from_bytes(buf[80:82], byteorder="big") / 10,
-            current=(int.from_bytes(buf[82:84], byteorder="big", signed=True) - 30000)
-            / 10,
-            soc=int.from_bytes(buf[84:86], byteorder="big") / 10,
-            charge=int.from_bytes(buf[4:6], byteorder="big", signed=True) / 100,
-            capacity=int.from_bytes(buf[6:8], byteorder="big", signed=True) / 100,
-            num_cycles=int.from_bytes(buf[8:10], byteorder="big", signed=True),
-            temperatures=[
-                (int.from_bytes(buf[23 + i * 2 : i * 2 + 25], "big") - 2731) / 10
-                for i in range(num_temp)
-            ],
-            switches=dict(
-                discharge=mos_byte == 2 or mos_byte == 3,
-                charge=mos_byte == 1 or mos_byte == 3,
-            ),
-            # charge_enabled
-            # discharge_enabled
-        )
-
-        self._switches = dict(sample.switches)
-
-        # print(dict(num_cell=num_cell, num_temp=num_temp))
+        reg = await self._read_registers()
 
-        # self.rawdat['P']=round(self.rawdat['Vbat']*self.rawdat['Ibat'], 1)
-        # self.rawdat['Bal'] = int.from_bytes(self.response[12:14], byteorder='big', signed=False)
+        num_temps = min(reg[REG_NUM_TEMPS], MAX_TEMPS)
 
-        product_date = int.from_bytes(buf[10:12], byteorder="big", signed=True)
-        # productDate = convertByteToUInt16(data1: data[14], data2: data[15])
-
-        return sample
+        return BmsSample(
+            voltage=reg[REG_VOLTAGE] / 10,
+            current=(reg[REG_CURRENT] - 30000) / 10,  # negative=charging, positive=discharging
+            soc=reg[REG_SOC] / 10,
+            charge=reg[REG_CHARGE] / 10,
+            num_cycles=reg[REG_NUM_CYCLES],
+            temperatures=[t - 40 for t in reg[REG_TEMPS : REG_TEMPS + num_temps]],
+        )
 
     async def fetch_voltages(self):
-        buf = await self._q(cmd=0x04)
-        num_cell = int(buf[3] / 2)
-        voltages = [
-            (int.from_bytes(buf[4 + i * 2 : i * 2 + 6], "big")) for i in range(num_cell)
-        ]
-        return voltages
-
-    async def set_switch(self, switch: str, state: bool):
-
-        assert switch in {"charge", "discharge"}
-
-        # see https://wiki.jmehan.com/download/attachments/59114595/JBD%20Protocol%20English%20version.pdf?version=1&modificationDate=1650716897000&api=v2
-        #
-        def jbd_checksum(cmd, data):
-            crc = 0x10000
-            for i in data + bytes([len(data), cmd]):
-                crc = crc - int(i)
-            return crc.to_bytes(2, byteorder="big")
-
-        def jbd_message(status_bit, cmd, data):
-            return (
-                bytes([0xDD, status_bit, cmd, len(data)])
-                + data
-                + jbd_checksum(cmd, data)
-                + bytes([0x77])
-            )
-
-        if not self._switches:
-            await self.fetch()
-
-        new_switches = {**self._switches, switch: state}
-        switches_sum = sum(new_switches.values())
-        if switches_sum == 2:
-            tc = 0x00  # all on
-        elif switches_sum == 0:
-            tc = 0x03  # all off
-        elif switch == "charge" and not state:
-            tc = 0x01  # charge off
-        else:
-            tc = 0x02  # charge on, discharge off
-
-        data = jbd_message(status_bit=0x5A, cmd=0xE1, data=bytes([0x00, tc]))  # all off
-        self.logger.info("send switch msg: %s", data)
-        await self.client.write_gatt_char(self.UUID_TX, data=data)
+        """
+        :return: cell voltages in mV, from the registers read by the last fetch()
+        """
+        reg = self._registers or await self._read_registers()
+        num_cells = reg[REG_NUM_CELLS]
+        assert 0 < num_cells <= MAX_CELLS, "num_cells %s outside range" % num_cells
+        return list(reg[REG_CELLS : REG_CELLS + num_cells])
+
+    def debug_data(self):
+        return self._last_response
+
+
+def test_daly2_decode():
+    # read command as sent by the Daly app
+    assert _modbus_read_command(0x00, NUM_REGISTERS) == bytes.fromhex("d2030000003ed7b9")
+
+    # hand-computed response: 4 cells, 2 temperature sensors, 13.3 V, charging with 3.0 A, 78.5 %, 100.0 Ah, 12 cycles
+    response = bytes.fromhex(
+        "d2037c"
+        + "0cf4 0cf5 0cf3 0cf6"  # cells
+        + " 0000" * 28
+        + "003f 0040"  # temperatures
+        + " 0000" * 6
+        + "0085 7512 0311"  # voltage, current, soc
+        + " 0000" * 5
+        + "03e8 0004 0002 000c"  # charge, number of cells, temperature sensors, cycles
+        + " 0000" * 10
+        + "2f74"  # crc
+    )
+
+    async def run():
+        bms = Daly2Bt("test_daly2", name="test")
+        bms.client._bms._response = lambda: response
+        await bms.connect()
+
+        sample = await bms.fetch()
+        assert sample.voltage == 13.3
+        assert sample.current == -3.0
+        assert sample.soc == 78.5
+        assert sample.charge == 100.0
+        assert sample.num_cycles == 12
+        assert sample.temperatures == [23, 24]
+        assert await bms.fetch_voltages() == [3316, 3317, 3315, 3318]
+
+        # a frame with a wrong crc is dropped
+        bms.client._bms._response = lambda: response[:-1] + b"\x00"
+        bms.TIMEOUT = 0.1
+        try:
+            await bms.fetch()
+            assert False
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(run())
 
 
 async def main():
-    # mac_address = 'A3161184-6D54-4B9E-8849-E755F10CEE12'
     mac_address = "A4:C1:38:44:48:E7"
-    # serial_service = '0000ff00-0000-1000-8000-00805f9b34fb'
-
-    bms = JbdBt(mac_address, name="jbd")
-    await bms.connect()
-    voltages = await bms.fetch_voltages()
-    print(voltages)
-    # sample = await bms.fetch()
-    # print(sample)
-    await bms.disconnect()
+
+    bms = Daly2Bt(mac_address, name="daly2")
+    async with bms:
+        sample = await bms.fetch()
+        print(sample, await bms.fetch_voltages())
 
 
 if __name__ == "__main__":
@@ -2,8 +2,10 @@
 This is code for a dummy BMS wich doesn't physically exist.
 
 """
+import asyncio
 import math
 import random
+import struct
 import time
 from functools import partial
 from threading import Thread
@@ -63,6 +65,8 @@ class BleakDummyClient:
             jk=JKDummy,
             jk11=partial(JKDummy, is_new_11x=True),
             jbd=JBDDummy,
+            daly=DalyDummy,
+            daly2=Daly2Dummy,
         )
         self._bms = dummy_classes[address[5:]]()
 
@@ -92,6 +96,9 @@ class BleakDummyClient:
     ):
         return await self._bms.start_notify(char_specifier, callback)
 
+    async def stop_notify(self, char_specifier):
+        pass
+
     async def write_gatt_char(
         self,
         char_specifier,
@@ -149,12 +156,17 @@ class JKDummy:
         elif data.startswith(b"\xaaU\x90\xeb\x96"):
             self.logger.info("dummy subscribe")
 
+            # bleak calls notification handlers in the event loop
+            loop = asyncio.get_running_loop()
+
             def send_data():
                 while True:
                     time.sleep(1)
                     for msg in self.MSGS:
-                        self._callbacks["0000ffe1-0000-1000-8000-00805f9b34fb"](
-                            self, bytes(msg)
+                        loop.call_soon_threadsafe(
+                            self._callbacks["0000ffe1-0000-1000-8000-00805f9b34fb"],
+                            self,
+                            bytes(msg),
                         )
 
             Thread(target=send_data, daemon=True).start()
@@ -163,23 +175,161 @@ class JKDummy:
 
 
 class JBDDummy:
-    def __init__(self):
+    """
+    Answers JBD commands 0x03 (basic info) and 0x04 (cell voltages) after `latency` seconds.
+    """
+
+    RX = "0000ff01-0000-1000-8000-00805f9b34fb"
+
+    BASIC_INFO = bytes.fromhex(
+        "dd03001b0a50fda4b717dac000002cf300000000000016540308020b7d0b77f8e277"
+    )
+
+    def __init__(self, latency=0.0):
         self._callbacks = {}
+        self.latency = latency
+        self.num_cells = self.BASIC_INFO[4 + 21]
 
     async def start_notify(
         self, char_specifier, callback: Callable[[int, bytearray], None]
     ):
         self._callbacks[char_specifier] = callback
 
+    @staticmethod
+    def _frame(command, data: bytes):
+        crc = (0x10000 - sum(data) - len(data)) & 0xFFFF
+        return bytes([0xDD, command, 0x00, len(data)]) + data + crc.to_bytes(2, "big") + b"\x77"
+
+    def _respond(self, command):
+        if command == 0x03:
+            msg = self.BASIC_INFO
+        else:
+            msg = self._frame(0x04, b"".join((3300 + i).to_bytes(2, "big") for i in range(self.num_cells)))
+        # BLE notifications carry 20 bytes
+        for i in range(0, len(msg), 20):
+            self._callbacks[self.RX](self, msg[i : i + 20])
+
     async def write_gatt_char(
         self,
         char_specifier,
         data: Union[bytes, bytearray, memoryview],
         response: bool = False,
     ):
-        if data == b"\xdd\xa5\x03\x00\xff\xfdw":
-            msg = bytearray.fromhex(
-                "dd03001b0a50fda4b717dac000002cf300000000000016540308020b7d0b77f8e277"
-            )
-            self._callbacks["0000ff01-0000-1000-8000-00805f9b34fb"](self, bytes(msg))
-        pass
+        if data in (b"\xdd\xa5\x03\x00\xff\xfdw", b"\xdd\xa5\x04\x00\xff\xfcw"):
+            asyncio.get_running_loop().call_later(self.latency, self._respond, data[2])
+
+
+class DalyDummy:
+    """
+    Answers Daly commands 0x90-0x96 after `latency` seconds, like a BMS would do over BLE. Responses to commands
+    written back-to-back overlap.
+    """
+
+    RX = 17
+
+    def __init__(self, latency=0.0):
+        self._callbacks = {}
+        self.latency = latency
+        self.num_cells = 8
+        self.num_temps = 1
+        self.logger = get_logger()
+
+    async def start_notify(
+        self, char_specifier, callback: Callable[[int, bytearray], None]
+    ):
+        self._callbacks[char_specifier] = callback
+
+    def _response_data(self, command):
+        if command == 0x90:
+            return [struct.pack(">h h h h", 265, 0, 30000 - 122, 658)]
+        if command == 0x93:
+            return [struct.pack(">b ? ? B l", 2, True, True, 5, 181000)]
+        if command == 0x94:
+            return [struct.pack(">b b ? ? b h x", self.num_cells, self.num_temps, True, True, 0b0010, 7)]
+        if command == 0x95:
+            cells = [3321 + i for i in range(self.num_cells)]
+            cells += [0] * (-len(cells) % 3)
+            return [
+                struct.pack(">b 3h x", i // 3 + 1, *cells[i : i + 3])
+                for i in range(0, len(cells), 3)
+            ]
+        if command == 0x96:
+            temps = [21 + 40 + i for i in range(self.num_temps)]
+            temps += [0] * (-len(temps) % 7)
+            return [
+                struct.pack(">b 7b", i // 7 + 1, *temps[i : i + 7])
+                for i in range(0, len(temps), 7)
+            ]
+        raise Exception("Daly dummy received unrecognized command %02x" % command)
+
+    def _respond(self, command):
+        callback = self._callbacks[self.RX]
+        for data in self._response_data(command):
+            frame = bytes([0xA5, 0x01, command, 0x08]) + data
+            callback(self, frame + bytes([sum(frame) & 0xFF]))
+
+    async def write_gatt_char(
+        self,
+        char_specifier,
+        data: Union[bytes, bytearray, memoryview],
+        response: bool = False,
+    ):
+        if not data:
+            # wake up
+            return
+
+        assert sum(data[:-1]) & 0xFF == data[-1]
+        asyncio.get_running_loop().call_later(self.latency, self._respond, data[2])
+
+
+class Daly2Dummy:
+    """
+    Answers the Daly Modbus register block read after `latency` seconds, in 20 byte notifications.
+    """
+
+    RX = "0000fff1-0000-1000-8000-00805f9b34fb"
+
+    def __init__(self, latency=0.0):
+        from .daly2 import NUM_REGISTERS
+
+        self._callbacks = {}
+        self.latency = latency
+        self.num_cells = 8
+        self.num_temps = 2
+        self.registers = [0] * NUM_REGISTERS
+
+    async def start_notify(
+        self, char_specifier, callback: Callable[[int, bytearray], None]
+    ):
+        self._callbacks[char_specifier] = callback
+
+    def _response(self):
+        from . import daly2
+
+        reg = self.registers
+        reg[: self.num_cells] = [3310 + i for i in range(self.num_cells)]
+        reg[daly2.REG_TEMPS : daly2.REG_TEMPS + self.num_temps] = [22 + 40 + i for i in range(self.num_temps)]
+        reg[daly2.REG_VOLTAGE] = 265
+        reg[daly2.REG_CURRENT] = 30000 - 122
+        reg[daly2.REG_SOC] = 658
+        reg[daly2.REG_CHARGE] = 1810
+        reg[daly2.REG_NUM_CELLS] = self.num_cells
+        reg[daly2.REG_NUM_TEMPS] = self.num_temps
+        reg[daly2.REG_NUM_CYCLES] = 7
+
+        frame = daly2.RESPONSE_HEADER + daly2.REGISTERS.pack(*reg)
+        return frame + struct.pack("<H", daly2.crc16_modbus(frame))
+
+    def _respond(self):
+        msg = self._response()
+        for i in range(0, len(msg), 20):
+            self._callbacks[self.RX](self, msg[i : i + 20])
+
+    async def write_gatt_char(
+        self,
+        char_specifier,
+        data: Union[bytes, bytearray, memoryview],
+        response: bool = False,
+    ):
+        if data == bytes.fromhex("D2 03 00 00 00 3E D7 B9"):
+            asyncio.get_running_loop().call_later(self.latency, self._respond)
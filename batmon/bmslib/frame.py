@@ -0,0 +1,148 @@
+import datetime
+import logging
+import time
+from collections import deque
+from typing import Callable, List, Optional, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class FrameTrace:
+    """
+    Bounded ring of raw BLE frames for post-mortem analysis. The trace is disabled by default and callers check
+    `trace.enabled` before calling record(), so a disabled trace costs a single attribute lookup in the notification
+    handler. Frames are kept as raw bytes, they are only formatted as text by dump().
+    With `every` > 1 only one in N frames is recorded. Bad frames are always recorded.
+    """
+
+    RX = "rx"
+    TX = "tx"
+    BAD = "bad"
+
+    def __init__(self, size=64):
+        self.enabled = False
+        self.every = 1
+        self.num_frames = 0
+        self._count = 0
+        self._ring = deque(maxlen=size)
+
+    def enable(self, every=1):
+        self.every = max(1, int(every))
+        self._count = 0
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def record(self, kind: str, data: Buffer):
+        if kind != self.BAD:
+            self._count += 1
+            if self._count < self.every:
+                return
+            self._count = 0
+        self.num_frames += 1
+        self._ring.append((time.time(), kind, bytes(data)))
+
+    def clear(self):
+        self._ring.clear()
+
+    def dump(self) -> List[str]:
+        return [
+            "%s %-3s %3d %s"
+            % (datetime.datetime.fromtimestamp(t).strftime("%H:%M:%S.%f")[:-3], kind, len(data), data.hex(" "))
+            for t, kind, data in self._ring
+        ]
+
+    def __len__(self):
+        return len(self._ring)
+
+    def __str__(self):
+        if not self.enabled:
+            return "FrameTrace(off,%d frames)" % len(self)
+        return "FrameTrace(1/%d,%d frames)" % (self.every, len(self))
+
+
+class FrameAssembler:
+    """
+    Reassemble frames from BLE notification fragments in a buffer allocated once.
+
+    A fragment starting with `header` starts a new frame. Once at least `frame_size` bytes are collected, the frame is
+    verified with `check`. If the check fails and there is another header in the buffer, the data before it is
+    discarded and the frame is re-assembled from there.
+    feed() returns a read-only view into the buffer, which is only valid until the next feed() call. Copy data that is
+    needed for longer.
+    """
+
+    def __init__(
+        self,
+        header: bytes,
+        frame_size: int,
+        check: Callable[[memoryview], bool],
+        max_frame_size: Optional[int] = None,
+        capacity: int = 1024,
+        logger: Optional[logging.Logger] = None,
+        trace: Optional[FrameTrace] = None,
+    ):
+        assert capacity >= frame_size
+        self.header = header
+        self.frame_size = frame_size
+        self.max_frame_size = max_frame_size or frame_size
+        self.check = check
+        self.logger = logger or logging.getLogger(__name__)
+        self.trace = trace if trace is not None else FrameTrace()
+        self.num_frames = 0
+        self.num_errors = 0
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._len = 0
+
+    def feed(self, data: Buffer) -> Optional[memoryview]:
+        """
+        :param data: notification fragment
+        :return: a complete, verified frame or None
+        """
+        n = len(data)
+
+        if data[0 : len(self.header)] == self.header:
+            self._len = 0
+
+        if self._len + n > len(self._buf):
+            self.logger.warning("frame buffer overflow (%d + %d bytes), discarding", self._len, n)
+            self.trace.record(FrameTrace.BAD, self._view[: self._len])
+            self._len = 0
+            self.num_errors += 1
+            if n > len(self._buf):
+                return None
+
+        self._view[self._len : self._len + n] = data
+        self._len += n
+
+        if self._len < self.frame_size:
+            return None
+
+        if self._len > self.max_frame_size:
+            self.logger.warning("buffer longer than expected %d", self._len)
+
+        frame_ok = self.check(self._view[: self._len])
+
+        if not frame_ok:
+            idx = self._buf.find(self.header, 1, self._len)
+            if idx > 0:
+                self.logger.debug("check failed, header at %d, discarding start of frame", idx)
+                self._view[: self._len - idx] = self._view[idx : self._len]
+                self._len -= idx
+                if self._len < self.frame_size:
+                    return None
+                frame_ok = self.check(self._view[: self._len])
+
+        frame_len = self._len
+        self._len = 0
+
+        if not frame_ok:
+            self.logger.error("check failed, discarding frame (%d bytes)", frame_len)
+            self.trace.record(FrameTrace.BAD, self._view[:frame_len])
+            self.num_errors += 1
+            return None
+
+        self.num_frames += 1
+        return self._view[:frame_len].toreadonly()
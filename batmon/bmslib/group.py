@@ -22,7 +22,7 @@ class BmsGroup:
             bms.name,
             self.bms_names,
         )
-        self.samples[bms.name] = copy(sample)
+        self.samples[bms.name] = sample
 
     def update_voltages(self, bms: BtBms, voltages: List[int]):
         assert bms.name in self.bms_names, "bms %s not in group %s" % (
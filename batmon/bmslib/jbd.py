@@ -12,17 +12,22 @@ https://github.com/tgalarneau/bms
 
 """
 import asyncio
-
-from batmon.bmslib import FuturesPool
+from typing import Dict, List, Optional, Tuple
 
 from .bms import BmsSample
 from .bt import BtBms
+from .frame import FrameTrace
 
 
 def _jbd_command(command: int):
     return bytes([0xDD, 0xA5, command, 0x00, 0xFF, 0xFF - (command - 1), 0x77])
 
 
+def _jbd_checksum_valid(frame) -> bool:
+    # 0x10000 minus the sum of status, data length and data
+    return (0x10000 - sum(frame[2:-3])) & 0xFFFF == int.from_bytes(frame[-3:-1], "big")
+
+
 class JbdBt(BtBms):
     UUID_RX = "0000ff01-0000-1000-8000-00805f9b34fb"
     UUID_TX = "0000ff02-0000-1000-8000-00805f9b34fb"
@@ -35,20 +40,40 @@ class JbdBt(BtBms):
         self._buffer = bytearray()
         self._switches = None
         self._last_response = None
+        self._voltages: Optional[List[int]] = None
 
     def _notification_handler(self, sender, data):
-
-        # print("bms msg {0}: {1}".format(sender, data))
+        if self.trace.enabled:
+            self.trace.record(FrameTrace.RX, data)
         self._buffer += data
 
-        if self._buffer.endswith(b"w"):
+        # frame: 0xDD, command, status, data length, data, checksum (2 bytes), 0x77
+        # several frames can arrive back-to-back when commands are pipelined
+        while True:
+            start = self._buffer.find(0xDD)
+            if start < 0:
+                self._buffer.clear()
+                return
+            if start > 0:
+                del self._buffer[:start]
+            if len(self._buffer) < 4:
+                return
+            frame_len = self._buffer[3] + 7
+            if len(self._buffer) < frame_len:
+                return
+
+            if self._buffer[frame_len - 1] != 0x77 or not _jbd_checksum_valid(self._buffer[:frame_len]):
+                self.logger.warning("invalid frame end or checksum, discarding")
+                self.trace.record(FrameTrace.BAD, self._buffer[:frame_len])
+                del self._buffer[:1]
+                continue
+
             command = self._buffer[1]
-            buf = self._buffer[:]
-            self._buffer.clear()
+            buf = bytes(self._buffer[:frame_len])
+            del self._buffer[:frame_len]
 
-            # print(command, 'buffer endswith w', self._buffer)
             self._last_response = buf
-            self._fetch_futures.set_result(command, buf)
+            self._requests.set_result(command, buf)
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
@@ -65,16 +90,31 @@ class JbdBt(BtBms):
         await super().disconnect()
 
     async def _q(self, cmd):
-        with self._fetch_futures.acquire(cmd):
+        # a partial frame left from a previous request must not be matched to this one
+        self._buffer.clear()
+        async with self._requests.request(cmd) as req:
             await self.client.write_gatt_char(self.UUID_TX, data=_jbd_command(cmd))
-            return await self._fetch_futures.wait_for(cmd, self.TIMEOUT)
+            return await req.wait(self.TIMEOUT)
+
+    async def _q_pipelined(self, cmds: Tuple[int, ...]) -> Dict[int, bytes]:
+        """
+        Write several commands back-to-back and wait for all responses, which takes about one BLE round trip.
+        """
+        self._buffer.clear()
+        async with self._requests.request(cmds) as req:
+            for cmd in cmds:
+                await self.client.write_gatt_char(self.UUID_TX, data=_jbd_command(cmd))
+            return dict(zip(cmds, await req.wait(self.TIMEOUT)))
 
     async def fetch(self) -> BmsSample:
         # binary reading
         #  https://github.com/NeariX67/SmartBMSUtility/blob/main/Smart%20BMS%20Utility/Smart%20BMS%20Utility/BMSData.swift
 
-        buf = await self._q(cmd=0x03)
-        buf = buf[4:]
+        # read cell voltages in the same round trip, for the following fetch_voltages()
+        resp = await self._q_pipelined((0x03, 0x04) if self.want_cells else (0x03,))
+        self._voltages = self._parse_voltages(resp[0x04]) if 0x04 in resp else None
+
+        buf = resp[0x03][4:]
 
         num_cell = int.from_bytes(buf[21:22], "big")
         num_temp = int.from_bytes(buf[22:23], "big")
@@ -113,7 +153,13 @@ class JbdBt(BtBms):
         return sample
 
     async def fetch_voltages(self):
-        buf = await self._q(cmd=0x04)
+        if self._voltages is not None:
+            voltages, self._voltages = self._voltages, None
+            return voltages
+        return self._parse_voltages(await self._q(cmd=0x04))
+
+    @staticmethod
+    def _parse_voltages(buf):
         num_cell = int(buf[3] / 2)
         voltages = [
             (int.from_bytes(buf[4 + i * 2 : i * 2 + 6], "big")) for i in range(num_cell)
@@ -162,6 +208,44 @@ class JbdBt(BtBms):
         return self._last_response
 
 
+def test_jbd_frame_resync():
+    async def run():
+        from batmon.bmslib.dummy import JBDDummy
+
+        bms = JbdBt("test_jbd", name="test")
+        await bms.connect()
+        good = JBDDummy.BASIC_INFO
+        bad_checksum = good[:-2] + bytes([good[-2] ^ 1]) + good[-1:]
+
+        # a corrupted frame followed by a good one, in 20 byte notifications
+        async with bms._requests.request(0x03) as req:
+            data = bad_checksum + good
+            for i in range(0, len(data), 20):
+                bms._notification_handler(None, data[i : i + 20])
+            assert await req.wait(1) == good
+        assert not bms._buffer
+
+        # the tail of a timed out response arrives after the next request was written, it must not complete the
+        # stale frame and answer the new request
+        old = bytearray(good)
+        old[5] += 1  # voltage
+        old[-3:-1] = ((0x10000 - sum(old[2:-3])) & 0xFFFF).to_bytes(2, "big")
+        old = bytes(old)
+        write = bms.client.write_gatt_char
+
+        async def write_with_late_tail(char, data, **kwargs):
+            bms._notification_handler(None, old[20:])
+            await write(char, data, **kwargs)
+
+        bms._notification_handler(None, old[:20])
+        bms.client.write_gatt_char = write_with_late_tail
+        resp = await bms._q_pipelined((0x03, 0x04))
+        assert resp[0x03] == good
+        assert bms._parse_voltages(resp[0x04])[0] == 3300
+
+    asyncio.run(run())
+
+
 async def main():
     # mac_address = 'A3161184-6D54-4B9E-8849-E755F10CEE12'
     mac_address = "A4:C1:38:44:48:E7"
@@ -13,11 +13,15 @@ fix connection abort:
 
 """
 import asyncio
+import math
+import struct
 from collections import defaultdict
+from functools import lru_cache
 from typing import Callable, Dict, List
 
 from batmon.bmslib.bms import BmsSample, DeviceInfo
 from batmon.bmslib.bt import BtBms
+from batmon.bmslib.frame import FrameAssembler, FrameTrace
 
 
 def calc_crc(message_bytes):
@@ -44,6 +48,24 @@ def _jk_command(address, value: list):
 
 MIN_RESPONSE_SIZE = 300
 MAX_RESPONSE_SIZE = 320
+HEADER = bytes([0x55, 0xAA, 0xEB, 0x90])
+
+# JK02 0x02 frame, fields at 118 (+32 with 11.x firmware):
+# voltage u32, -, current i32, temp1 i16, temp2 i16, mos temp i16, -, balance current i16, -, soc u8,
+# charge u32, capacity u32, num cycles u32, cycle capacity u32, -, uptime u32
+JK02_SAMPLE = struct.Struct("<I4xihhh2xhxBIIII4xI")
+JK02_SAMPLE_OFFSET = 118
+JK02_CURRENT = struct.Struct("<I4xi")  # voltage, current
+JK02_CELLS_OFFSET = 6
+
+
+@lru_cache(maxsize=None)
+def _cells_struct(num_cells: int) -> struct.Struct:
+    return struct.Struct("<%dH" % num_cells)
+
+
+def _temp(x):
+    return math.nan if x == -2000 else (x / 10)
 
 
 class JKBt(BtBms):
@@ -55,66 +77,51 @@ class JKBt(BtBms):
         super().__init__(address, **kwargs)
         if kwargs.get("psk"):
             self.logger.warning("JK usually does not use a pairing PIN")
-        self._buffer = bytearray()
-        self._resp_table = {}
+        self._frames = FrameAssembler(
+            HEADER,
+            frame_size=MIN_RESPONSE_SIZE,
+            max_frame_size=MAX_RESPONSE_SIZE,
+            check=self._frame_crc_check,
+            logger=self.logger,
+            trace=self.trace,
+        )
+        # one buffer per response type, frames are copied into and decoded from them
+        self._slots: Dict[int, bytearray] = {}
+        self._slot_views: Dict[int, memoryview] = {}
+        self._resp_table: Dict[int, memoryview] = {}
         self.num_cells = None
-        self._callbacks: Dict[int, List[Callable[[bytes], None]]] = defaultdict(List)
+        self._callbacks: Dict[int, List[Callable[[memoryview], None]]] = defaultdict(list)
         self.char_handle_notify = self.CHAR_UUID
         self.char_handle_write = self.CHAR_UUID
 
-    def _buffer_crc_check(self):
-        crc_comp = calc_crc(self._buffer[0 : MIN_RESPONSE_SIZE - 1])
-        crc_expected = self._buffer[MIN_RESPONSE_SIZE - 1]
+    def _frame_crc_check(self, frame: memoryview):
+        crc_comp = calc_crc(frame[0 : MIN_RESPONSE_SIZE - 1])
+        crc_expected = frame[MIN_RESPONSE_SIZE - 1]
         if crc_comp != crc_expected:
-            self.logger.debug(
-                "crc check failed, %s != %s, %s", crc_comp, crc_expected, self._buffer
-            )
+            self.logger.debug("crc check failed, %s != %s", crc_comp, crc_expected)
         return crc_comp == crc_expected
 
     def _notification_handler(self, sender, data):
-        HEADER = bytes([0x55, 0xAA, 0xEB, 0x90])
+        if self.trace.enabled:
+            self.trace.record(FrameTrace.RX, data)
 
-        if data[0:4] == HEADER:  # and len(self._buffer)
-            self.logger.debug("header, clear buf %s", self._buffer)
-            self._buffer.clear()
+        frame = self._frames.feed(data)
+        if frame is not None:
+            self._decode_msg(frame)
 
-        self._buffer += data
+    def _decode_msg(self, frame: memoryview):
+        resp_type = frame[4]
 
-        self.logger.debug(
-            "bms msg(%d) (buf%d): %s\n", len(data), len(self._buffer), to_hex_str(data)
-        )
+        n = len(frame)
+        slot = self._slots.get(resp_type)
+        if slot is None or len(slot) < n:
+            slot = self._slots[resp_type] = bytearray(max(n, MAX_RESPONSE_SIZE))
+            self._slot_views[resp_type] = memoryview(slot).toreadonly()
+        slot[:n] = frame
+        buf = self._slot_views[resp_type][:n]
 
-        if len(self._buffer) >= MIN_RESPONSE_SIZE:
-            if len(self._buffer) > MAX_RESPONSE_SIZE:
-                self.logger.warning(
-                    "buffer longer than expected %d %s", len(self._buffer), self._buffer
-                )
-
-            crc_ok = self._buffer_crc_check()
-
-            if not crc_ok and HEADER in self._buffer:
-                idx = self._buffer.index(HEADER)
-                self.logger.debug(
-                    "crc check failed, header at %d, discarding start of %s",
-                    idx,
-                    self._buffer,
-                )
-                self._buffer = self._buffer[idx:]
-                crc_ok = self._buffer_crc_check()
-
-            if not crc_ok:
-                self.logger.error(
-                    "crc check failed, discarding buffer %s", self._buffer
-                )
-            else:
-                self._decode_msg(bytearray(self._buffer))
-            self._buffer.clear()
-
-    def _decode_msg(self, buf):
-        resp_type = buf[4]
-        self.logger.debug("got response %d (len%d)", resp_type, len(buf))
         self._resp_table[resp_type] = buf
-        self._fetch_futures.set_result(resp_type, self._buffer[:])
+        self._requests.set_result(resp_type, buf)
         callbacks = self._callbacks.get(resp_type, None)
         if callbacks:
             for cb in callbacks:
@@ -169,11 +176,11 @@ class JKBt(BtBms):
         await super().disconnect()
 
     async def _q(self, cmd, resp):
-        with self._fetch_futures.acquire(resp):
+        async with self._requests.request(resp) as req:
             frame = _jk_command(cmd, [])
             self.logger.debug("write %s", frame)
             await self.client.write_gatt_char(self.char_handle_write, data=frame)
-            return await self._fetch_futures.wait_for(resp, self.TIMEOUT)
+            return await req.wait(self.TIMEOUT)
 
     async def _write(self, address, value):
         frame = _jk_command(address, value)
@@ -182,7 +189,7 @@ class JKBt(BtBms):
     async def fetch_device_info(self):
         # https://github.com/jblance/mpp-solar/blob/master/mppsolar/protocols/jkabstractprotocol.py
         # https://github.com/syssi/esphome-jk-bms/blob/main/components/jk_bms_ble/jk_bms_ble.cpp#L1059
-        buf = self._resp_table[0x03]
+        buf = bytes(self._resp_table[0x03])
         return DeviceInfo(
             model=read_str(buf, 6),
             hw_version=read_str(buf, 6 + 16),
@@ -191,50 +198,61 @@ class JKBt(BtBms):
             sn=read_str(buf, 6 + 16 + 8 + 16 + 40),
         )
 
+    @staticmethod
+    def _fw_offset(buf) -> int:
+        # new 11.x firmware shifts the fields after the cell data by 32 bytes
+        is_new_11fw = buf[189] == 0x00 and buf[189 + 32] > 0
+        return 32 if is_new_11fw else 0
+
+    def _decode_current(self, buf):
+        """
+        Decode only voltage and current of a 0x02 frame, for the high-rate stream
+        :return: voltage in V, current in A (positive=discharging)
+        """
+        voltage, current = JK02_CURRENT.unpack_from(buf, JK02_SAMPLE_OFFSET + self._fw_offset(buf))
+        return voltage * 1e-3, -(current * 1e-3)
+
     def _decode_sample(self, buf) -> BmsSample:
         buf_set = self._resp_table[0x01]
 
-        is_new_11fw = buf[189] == 0x00 and buf[189 + 32] > 0
-        offset = 0
-        if is_new_11fw:
-            offset = 32
+        offset = self._fw_offset(buf)
+        if offset:
             self.logger.debug("New 11.x firmware, offset=%s", offset)
 
-        i16 = lambda i: int.from_bytes(
-            buf[i : (i + 2)], byteorder="little", signed=True
-        )
-        u32 = lambda i: int.from_bytes(
-            buf[i : (i + 4)], byteorder="little", signed=False
-        )
-        f32u = lambda i: u32(i) * 1e-3
-        f32s = (
-            lambda i: int.from_bytes(buf[i : (i + 4)], byteorder="little", signed=True)
-            * 1e-3
-        )
-
-        temp = lambda x: float("nan") if x == -2000 else (x / 10)
+        (
+            voltage,
+            current,
+            temp1,
+            temp2,
+            mos_temp,
+            balance_current,
+            soc,
+            charge,
+            capacity,
+            num_cycles,
+            cycle_capacity,
+            uptime,
+        ) = JK02_SAMPLE.unpack_from(buf, JK02_SAMPLE_OFFSET + offset)
 
         return BmsSample(
-            voltage=f32u(118 + offset),
-            current=-f32s(126 + offset),
-            soc=buf[141 + offset],
-            cycle_capacity=f32u(154 + offset),  # total charge TODO rename cycle charge
-            capacity=f32u(
-                146 + offset
-            ),  # computed capacity (starts at self.capacity, which is user-defined),
-            charge=f32u(142 + offset),  # "remaining capacity"
-            temperatures=[temp(i16(130 + offset)), temp(i16(132 + offset))],
-            mos_temperature=i16(134 + offset) / 10,
-            balance_current=i16(138 + offset) / 1000,
+            voltage=voltage * 1e-3,
+            current=-(current * 1e-3),
+            soc=soc,
+            cycle_capacity=cycle_capacity * 1e-3,  # total charge TODO rename cycle charge
+            capacity=capacity * 1e-3,  # computed capacity (starts at self.capacity, which is user-defined),
+            charge=charge * 1e-3,  # "remaining capacity"
+            temperatures=[_temp(temp1), _temp(temp2)],
+            mos_temperature=mos_temp / 10,
+            balance_current=balance_current / 1000,
             # 146 charge_full (see above)
-            num_cycles=u32(150 + offset),
+            num_cycles=num_cycles,
             switches=dict(
                 charge=bool(buf_set[118]),
                 discharge=bool(buf_set[122]),
             ),
             #  #buf[166 + offset]),  charge FET state
             # buf[167 + offset]), discharge FET state
-            uptime=float(u32(162 + offset)),  # seconds
+            uptime=float(uptime),  # seconds
         )
 
     async def fetch(self, wait=True) -> BmsSample:
@@ -247,8 +265,8 @@ class JKBt(BtBms):
         """
 
         if wait:
-            with self._fetch_futures.acquire(0x02):
-                await self._fetch_futures.wait_for(0x02, self.TIMEOUT)
+            async with self._requests.request(0x02) as req:
+                await req.wait(self.TIMEOUT)
 
         buf = self._resp_table[0x02]
         return self._decode_sample(buf)
@@ -256,6 +274,9 @@ class JKBt(BtBms):
     async def subscribe(self, callback: Callable[[BmsSample], None]):
         self._callbacks[0x02].append(lambda buf: callback(self._decode_sample(buf)))
 
+    async def subscribe_current(self, callback: Callable[[float, float], None]):
+        self._callbacks[0x02].append(lambda buf: callback(*self._decode_current(buf)))
+
     async def fetch_voltages(self):
         """
         :return: list of cell voltages in mV
@@ -263,11 +284,7 @@ class JKBt(BtBms):
         if self.num_cells is None:
             raise Exception("num_cells not set")
         buf = self._resp_table[0x02]
-        voltages = [
-            int.from_bytes(buf[(6 + i * 2) : (6 + i * 2 + 2)], byteorder="little")
-            for i in range(self.num_cells)
-        ]
-        return voltages
+        return list(_cells_struct(self.num_cells).unpack_from(buf, JK02_CELLS_OFFSET))
 
     async def set_switch(self, switch: str, state: bool):
         # from https://github.com/syssi/esphome-jk-bms/blob/4079c22eaa40786ffa0cabd45d0d98326a1fdd29/components/jk_bms_ble/switch/__init__.py
@@ -277,11 +294,10 @@ class JKBt(BtBms):
         await self._q(cmd=0x96, resp=(0x02, 0x01))  # query settings
 
     def debug_data(self):
-        return self._resp_table
+        return {resp_type: bytes(buf) for resp_type, buf in self._resp_table.items()}
 
 
 async def main():
-    # await bmslib.bt.bt_discovery(logger=get_logger())
     # mac_address = 'F21958DF-E949-4D43-B12B-0020365C428A' # caravan
     mac_address = "46A9A7A1-D6C6-59C5-52D0-79EC8C77F4D2"  # bat100ah
 
@@ -0,0 +1,64 @@
+"""
+Registry of BMS types. A driver module is only imported when its type is used in the config, so start-up doesn't
+pay for drivers (and their dependencies) that are not needed.
+
+"""
+import importlib
+import re
+import subprocess
+import sys
+
+BMS_REGISTRY = dict(
+    daly="batmon.bmslib.daly:DalyBt",
+    daly2="batmon.bmslib.daly2:Daly2Bt",
+    jbd="batmon.bmslib.jbd:JbdBt",
+    jk="batmon.bmslib.jikong:JKBt",
+    victron="batmon.bmslib.victron:SmartShuntBt",
+    group_parallel="batmon.bmslib.group:VirtualGroupBms",
+    # group_serial="batmon.bmslib.group:VirtualGroupBms", # TODO
+    dummy="batmon.bmslib.dummy:DummyBt",
+)
+
+# types that are not bluetooth devices and don't need discovery
+VIRTUAL_BMS_TYPES = {"group_parallel", "dummy"}
+
+
+def load_bms_class(bms_type: str):
+    """
+    Import the driver module of a BMS type and return its class
+    :param bms_type: type name as used in the device config (jk, daly, ..)
+    """
+    module_name, class_name = BMS_REGISTRY[bms_type].split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def import_times(module: str):
+    """
+    Import a module in a fresh interpreter with `-X importtime`
+    :return: dict of imported module name -> cumulative import time in us
+    """
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in p.stderr.splitlines():
+        m = re.match(r"import time:\s+\d+\s+\|\s+(\d+)\s+\|\s+(\S+)", line)
+        if m:
+            times[m.group(2)] = int(m.group(1))
+    return times
+
+
+def test_import_time():
+    times = import_times("batmon.main")
+    heavy = set(n.split(".")[0] for n in times) & {"bleak", "paho", "backoff", "dbus_fast"}
+    assert not heavy, "batmon.main imports %s at import time" % heavy
+    drivers = set(m.split(":")[0] for m in BMS_REGISTRY.values()) & set(times)
+    assert not drivers, "batmon.main imports drivers %s at import time" % drivers
+    print("import batmon.main took %.1f ms" % (times["batmon.main"] * 1e-3))
+
+
+if __name__ == "__main__":
+    test_import_time()
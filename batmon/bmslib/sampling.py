@@ -1,22 +1,113 @@
+import asyncio
 import datetime
 import random
 import re
 import time
-from typing import Optional
+from collections import deque
+from typing import NamedTuple, Optional, Tuple
 
 import paho.mqtt.client
 
 import batmon.bmslib.bt
 from batmon.bmslib.algorithm import BatterySwitches, create_algorithm
-from batmon.bmslib.bms import DeviceInfo
+from batmon.bmslib.bms import BmsSample, DeviceInfo
 from batmon.bmslib.group import BmsGroup, GroupNotReady
 from batmon.bmslib.pwmath import DiffAbsSum, Integrator
+from batmon.bmslib.scheduler import CircuitBreaker
 from batmon.bmslib.util import get_logger
-from batmon.mqtt_util import (mqtt_single_out, publish_cell_voltages, publish_hass_discovery, publish_sample,
-                              publish_temperatures, round_to_n, subscribe_switches)
+from batmon.mqtt_util import (SampleEncoder, mqtt_single_out, publish_hass_discovery, publish_json_state,
+                              subscribe_switches, subscribe_trace)
 
 logger = get_logger(verbose=False)
 
+# seconds to wait for a BMS to push a sample
+PUSH_TIMEOUT = 10
+
+
+class SampleRecord(NamedTuple):
+    """
+    Everything read from a BMS in one sample() call that is to be published. Records are produced while the BMS is
+    connected and published later, so they must not be changed after creation.
+    """
+
+    sampler: "BmsSampler"
+    timestamp: float
+    sample: BmsSample
+    voltages: Tuple[int, ...]
+    temperatures: Tuple[float, ...]
+    meters: Tuple[Tuple[str, float], ...]
+    device_info: Optional[DeviceInfo]
+
+    def coalesce(self, older: "SampleRecord") -> "SampleRecord":
+        """
+        Merge an older, not yet published record of the same sampler into this one
+        """
+        return self._replace(device_info=self.device_info or older.device_info)
+
+
+class SampleQueue:
+    """
+    Bounded queue between the BMS samplers (producers) and the MQTT publisher (consumer). Putting never blocks, so a
+    slow broker can not delay the BLE communication. If the queue is full, the oldest record is dropped.
+    With the `coalesce` policy, a new record replaces a queued record of the same sampler, so each BMS has at most one
+    record in the queue and the publisher only sees the most recent state.
+    """
+
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+
+    def __init__(self, maxsize=32, policy=COALESCE):
+        assert policy in {self.DROP_OLDEST, self.COALESCE}, "unknown queue policy %s" % policy
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.policy = policy
+        self.num_put = 0
+        self.num_dropped = 0
+        self.num_coalesced = 0
+        self.max_depth = 0
+        self._items = deque()
+        self._not_empty = asyncio.Event()
+
+    def put_nowait(self, record: SampleRecord):
+        self.num_put += 1
+
+        if self.policy == self.COALESCE:
+            for i, queued in enumerate(self._items):
+                if queued.sampler is record.sampler:
+                    del self._items[i]
+                    record = record.coalesce(queued)
+                    self.num_coalesced += 1
+                    break
+
+        if len(self._items) >= self.maxsize:
+            self._items.popleft()
+            self.num_dropped += 1
+
+        self._items.append(record)
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._not_empty.set()
+
+    async def get(self) -> SampleRecord:
+        while not self._items:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self._items.popleft()
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+    def __str__(self):
+        return "SampleQueue(%s,depth=%d/%d,max=%d,put=%d,dropped=%d,coalesced=%d)" % (
+            self.policy,
+            self.depth,
+            self.maxsize,
+            self.max_depth,
+            self.num_put,
+            self.num_dropped,
+            self.num_coalesced,
+        )
+
 
 class BmsSampler:
     def __init__(
@@ -31,6 +122,11 @@ class BmsSampler:
         algorithms: Optional[list] = None,
         current_correction_factor=1.0,
         bms_group: Optional[BmsGroup] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        sample_queue: Optional[SampleQueue] = None,
+        push_mode=False,
+        stream_meters=False,
+        json_payload=False,
     ):
         self.bms = bms
         self.mqtt_topic_prefix = re.sub(r"[^\w_.-]", "_", bms.name)
@@ -42,8 +138,23 @@ class BmsSampler:
         self.publish_period = publish_period
         self.bms_group = bms_group  # group, virtual, parent
         self.current_correction_factor = current_correction_factor
-
+        # invert_current and current_correction_factor as one factor, applied with a single multiply_current()
+        self.current_factor = (-1 if invert_current else 1) * (current_correction_factor or 1)
+        self.breaker = breaker
+        self.sample_queue = sample_queue
+        self.push_mode = push_mode
+        self.stream_meters = stream_meters
+        self.dt_max_seconds = dt_max_seconds
+        self.json_payload = json_payload
+        self.encoder = SampleEncoder(self.mqtt_topic_prefix)
+
+        # latest sample pushed by the bms, None until subscribed
+        self._pushed: Optional[asyncio.Queue] = None
+        self._meters_subscribed: Optional[bool] = None
+        self._t_stream = 0.0  # time of the last streamed current reading
         self._t_pub = 0
+        self._switches_subscribed = False
+        self._trace_subscribed: Optional[bool] = None
 
         self.algorithm = None
         if algorithms:
@@ -83,29 +194,69 @@ class BmsSampler:
             if meter_state and meter.name in meter_state:
                 meter.restore(meter_state[meter.name]["reading"])
 
+    def __str__(self):
+        return "BmsSampler(%s)" % self.bms.name
+
     def get_meter_state(self):
         return {meter.name: dict(reading=meter.get()) for meter in self.meters}
 
     async def __call__(self):
+        if self.breaker and not self.breaker.allow():
+            return
+
         try:
-            return await self.sample()
+            res = await self.sample()
         except Exception:
+            if self.breaker:
+                self._breaker_update(success=False)
             dd = self.bms.debug_data()
             if dd:
                 logger.info("%s bms debug data: %s", self.bms.name, dd)
             if self.device_info:
                 logger.info("%s device info: %s", self.device_info)
+            trace = getattr(self.bms, "trace", None)
+            if trace is not None and len(trace):
+                logger.info("%s %s:\n%s", self.bms.name, trace, "\n".join(trace.dump()))
             logger.info("Bleak version %s", batmon.bmslib.bt.bleak_version())
             raise
 
+        if self.breaker:
+            self._breaker_update(success=True)
+        return res
+
+    def _breaker_update(self, success: bool):
+        was_open = self.breaker.is_open
+        if success:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+        if was_open != self.breaker.is_open:
+            if self.breaker.is_open:
+                logger.warning(
+                    "%s circuit breaker open after %d errors, next attempt in %.0fs",
+                    self.bms.name,
+                    self.breaker.num_failures,
+                    self.breaker.time_to_probe(),
+                )
+            else:
+                logger.info("%s circuit breaker closed", self.bms.name)
+            mqtt_single_out(
+                self.mqtt_client,
+                f"{self.mqtt_topic_prefix}/bms/breaker",
+                self.breaker.state,
+            )
+
     async def sample(self):
         bms = self.bms
-        mqtt_client = self.mqtt_client
 
         was_connected = bms.is_connected
 
         if not was_connected:
             logger.info("connecting bms %s", bms)
+            if self._pushed is not None and not self._pushed.empty():
+                # pushed during the previous connection, wait for a sample of the new one
+                self._pushed.get_nowait()
 
         t_conn = time.time()
 
@@ -116,7 +267,16 @@ class BmsSampler:
 
                 t_fetch = time.time()
 
-                sample = await bms.fetch()
+                # every 60 samples, publish even if publish_period is not due and retry fetching the device info
+                refresh = (self.num_samples % 60) == 0
+                # only let the BMS read cell voltages along with the sample if they are going to be published
+                bms.want_cells = (
+                    refresh
+                    or not self.publish_period
+                    or (t_fetch - self._t_pub) >= self.publish_period
+                )
+
+                sample = await self._fetch()
 
                 t_now = time.time()
                 t_hour = t_now * (1 / 3600)
@@ -128,27 +288,28 @@ class BmsSampler:
                 if self.bms_group:
                     self.bms_group.update(bms, sample)
 
-                # discharging P>0
-                self.power_integrator_charge += (
-                    t_hour,
-                    abs(min(0, sample.power)) * 1e-3,
-                )  # kWh
-                self.power_integrator_discharge += (
-                    t_hour,
-                    abs(max(0, sample.power)) * 1e-3,
-                )  # kWh
+                if self.stream_meters and self._meters_subscribed is None:
+                    await self._subscribe_meters()
 
-                if self.invert_current:
-                    sample = sample.invert_current()
+                # while the bms streams current readings, they feed the energy meters instead of the samples
+                streaming = (t_now - self._t_stream) <= self.dt_max_seconds
 
-                if (
-                    self.current_correction_factor
-                    and self.current_correction_factor != 1
-                ):
-                    sample = sample.multiply_current(self.current_correction_factor)
+                if not streaming:
+                    # discharging P>0
+                    self.power_integrator_charge += (
+                        t_hour,
+                        abs(min(0, sample.power)) * 1e-3,
+                    )  # kWh
+                    self.power_integrator_discharge += (
+                        t_hour,
+                        abs(max(0, sample.power)) * 1e-3,
+                    )  # kWh
 
-                self.current_integrator += (t_hour, sample.current)  # Ah
-                self.power_integrator += (t_hour, sample.power * 1e-3)  # kWh
+                sample = sample.multiply_current(self.current_factor)
+
+                if not streaming:
+                    self.current_integrator += (t_hour, sample.current)  # Ah
+                    self.power_integrator += (t_hour, sample.power * 1e-3)  # kWh
 
                 self.cycle_integrator += (
                     t_hour,
@@ -188,59 +349,23 @@ class BmsSampler:
                                 )
                                 await self.bms.set_switch("charge", res.switches[swk])
 
-                if self.num_samples == 0 and sample.switches:
-                    logger.info(
-                        "%s subscribing for %s switch change", bms.name, sample.switches
-                    )
-                    subscribe_switches(
-                        mqtt_client,
-                        device_topic=self.mqtt_topic_prefix,
-                        bms=bms,
-                        switches=sample.switches.keys(),
-                    )
-
-                publish_discovery = (self.num_samples % 60) == 0
+                record = None
+                voltages = temperatures = None
 
                 if (
-                    publish_discovery
+                    refresh
                     or not self.publish_period
                     or (t_now - self._t_pub) >= self.publish_period
                 ):
                     self._t_pub = t_now
 
-                    publish_sample(
-                        mqtt_client, device_topic=self.mqtt_topic_prefix, sample=sample
-                    )
-                    logger.info("%s: %s", bms.name, sample)
-
-                    self.publish_meters()
-
                     voltages = await bms.fetch_voltages()
                     if self.bms_group:
                         self.bms_group.update_voltages(bms, voltages)
-                    publish_cell_voltages(
-                        mqtt_client,
-                        device_topic=self.mqtt_topic_prefix,
-                        voltages=voltages,
-                    )
 
                     temperatures = sample.temperatures or await bms.fetch_temperatures()
-                    publish_temperatures(
-                        mqtt_client,
-                        device_topic=self.mqtt_topic_prefix,
-                        temperatures=temperatures,
-                    )
-                    if voltages or temperatures:
-                        logger.info(
-                            "%s volt=%s temp=%s",
-                            bms.name,
-                            ",".join(map(str, voltages)),
-                            temperatures,
-                        )
 
-                # publish home assistant discovery every 60 samples
-                if publish_discovery:
-                    if self.device_info is None:
+                    if refresh and self.device_info is None:
                         try:
                             self.device_info = await bms.fetch_device_info()
                         except NotImplementedError:
@@ -249,13 +374,14 @@ class BmsSampler:
                             logger.warning(
                                 "%s error fetching device info: %s", bms.name, e
                             )
-                    publish_hass_discovery(
-                        mqtt_client,
-                        device_topic=self.mqtt_topic_prefix,
-                        expire_after_seconds=self.expire_after_seconds,
+
+                    record = SampleRecord(
+                        sampler=self,
+                        timestamp=t_now,
                         sample=sample,
-                        num_cells=len(voltages),
-                        num_temp_sensors=len(temperatures),
+                        voltages=tuple(voltages or ()),
+                        temperatures=tuple(temperatures or ()),
+                        meters=tuple((meter.name, meter.get()) for meter in self.meters),
                         device_info=self.device_info,
                     )
 
@@ -269,14 +395,152 @@ class BmsSampler:
             logger.error("%s error: %s", bms.name, str(ex) or str(type(ex)))
             raise
 
+        # publish after the BMS has been released, so MQTT and logging don't hold the BLE connection
+        if record:
+            if self.sample_queue:
+                self.sample_queue.put_nowait(record)
+            else:
+                self.publish(record)
+
         dt_conn = t_fetch - t_conn
         dt_fetch = t_disc - t_fetch
         if self.bms.verbose_log or max(dt_conn, dt_fetch) > 1 or random.random() < 0.05:
             logger.info("%s times: connect=%.2fs fetch=%.2fs", bms, dt_conn, dt_fetch)
 
-    def publish_meters(self):
-        device_topic = self.mqtt_topic_prefix
-        for meter in self.meters:
-            topic = f"{device_topic}/meter/{meter.name}"
-            s = round_to_n(meter.get(), 4)
-            mqtt_single_out(self.mqtt_client, topic, s)
+    async def _subscribe(self) -> bool:
+        """
+        Subscribe to the samples the BMS sends on its own.
+        :return: False if the BMS does not support it
+        """
+        loop = asyncio.get_running_loop()
+        pushed = asyncio.Queue(maxsize=1)
+
+        def put_latest(sample: BmsSample):
+            if pushed.full():
+                pushed.get_nowait()
+            pushed.put_nowait(sample)
+
+        subscribe = getattr(self.bms, "subscribe", None)
+        if subscribe is None:
+            return False
+
+        try:
+            # notification handlers might be called from another thread
+            await subscribe(lambda sample: loop.call_soon_threadsafe(put_latest, sample))
+        except NotImplementedError:
+            return False
+
+        self._pushed = pushed
+        return True
+
+    async def _subscribe_meters(self):
+        """
+        Subscribe to the high-rate current readings of the BMS, to integrate the energy meters at a higher
+        resolution than the sample period.
+        """
+        loop = asyncio.get_running_loop()
+        subscribe = getattr(self.bms, "subscribe_current", None)
+        try:
+            if subscribe is None:
+                raise NotImplementedError()
+            await subscribe(
+                lambda voltage, current: loop.call_soon_threadsafe(
+                    self._integrate_current, voltage, current
+                )
+            )
+            self._meters_subscribed = True
+            logger.info("%s energy meters integrate streamed current", self.bms.name)
+        except NotImplementedError:
+            self._meters_subscribed = False
+            logger.info("%s does not stream current, energy meters use samples", self.bms.name)
+
+    def _integrate_current(self, voltage: float, current: float):
+        t_now = time.time()
+        t_hour = t_now * (1 / 3600)
+        power = voltage * current
+
+        # discharging P>0
+        self.power_integrator_charge += (t_hour, abs(min(0, power)) * 1e-3)  # kWh
+        self.power_integrator_discharge += (t_hour, abs(max(0, power)) * 1e-3)  # kWh
+
+        current *= self.current_factor
+        power *= self.current_factor
+
+        self.current_integrator += (t_hour, current)  # Ah
+        self.power_integrator += (t_hour, power * 1e-3)  # kWh
+        self._t_stream = t_now
+
+    async def _fetch(self) -> BmsSample:
+        """
+        In push mode, take the latest sample pushed by the BMS (or wait for the next one), otherwise request a
+        sample from the BMS.
+        """
+        if self.push_mode and self._pushed is None:
+            if await self._subscribe():
+                logger.info("%s push mode, sampling from BMS notifications", self.bms.name)
+            else:
+                logger.info("%s does not support push mode, polling", self.bms.name)
+                self.push_mode = False
+
+        if self._pushed is not None:
+            return await asyncio.wait_for(self._pushed.get(), PUSH_TIMEOUT)
+
+        return await self.bms.fetch()
+
+    def publish(self, record: SampleRecord):
+        bms = self.bms
+        mqtt_client = self.mqtt_client
+        sample = record.sample
+
+        if self._trace_subscribed is None:
+            self._trace_subscribed = hasattr(bms, "trace")
+            if self._trace_subscribed:
+                subscribe_trace(mqtt_client, device_topic=self.mqtt_topic_prefix, bms=bms)
+
+        if not self._switches_subscribed and sample.switches:
+            logger.info(
+                "%s subscribing for %s switch change", bms.name, sample.switches
+            )
+            subscribe_switches(
+                mqtt_client,
+                device_topic=self.mqtt_topic_prefix,
+                bms=bms,
+                switches=sample.switches.keys(),
+            )
+            self._switches_subscribed = True
+
+        if self.json_payload:
+            publish_json_state(
+                mqtt_client,
+                device_topic=self.mqtt_topic_prefix,
+                sample=sample,
+                voltages=record.voltages,
+                temperatures=record.temperatures,
+                meters=record.meters,
+            )
+        else:
+            self.encoder.publish_sample(mqtt_client, sample)
+            self.encoder.publish_meters(mqtt_client, record.meters)
+            self.encoder.publish_cell_voltages(mqtt_client, record.voltages)
+            self.encoder.publish_temperatures(mqtt_client, record.temperatures)
+
+        logger.info("%s: %s", bms.name, sample)
+        if record.voltages or record.temperatures:
+            logger.info(
+                "%s volt=%s temp=%s",
+                bms.name,
+                ",".join(map(str, record.voltages)),
+                list(record.temperatures),
+            )
+
+        # only sent if something changed, e.g. the number of cells or the device info
+        publish_hass_discovery(
+            mqtt_client,
+            device_topic=self.mqtt_topic_prefix,
+            expire_after_seconds=self.expire_after_seconds,
+            sample=sample,
+            num_cells=len(record.voltages),
+            num_temp_sensors=len(record.temperatures),
+            device_info=record.device_info,
+            json_state=self.json_payload,
+        )
@@ -0,0 +1,130 @@
+import asyncio
+import math
+import random
+import time
+
+
+class DeadlineTicker:
+    """
+    Periodic ticks planned against absolute deadlines on a monotonic clock, so the loop period does not drift by the
+    time spent in the loop body. If the body overruns, the missed ticks are merged into a single immediate tick and
+    the schedule continues on the original time grid.
+    """
+
+    def __init__(self, period: float, name: str = ""):
+        self.period = period
+        self.name = name
+        self.num_ticks = 0
+        self.num_overruns = 0
+        self.num_skipped = 0
+        self.jitter_max = 0.0
+        self._jitter_sum = 0.0
+        self._t_next = math.nan
+
+    async def wait(self):
+        """
+        Wait for the next tick. The first call returns immediately and anchors the time grid.
+        """
+        now = time.monotonic()
+
+        if math.isnan(self._t_next):
+            self._t_next = now
+        else:
+            self._t_next += self.period
+            if now > self._t_next + self.period:
+                # overrun: skip all ticks we missed, but keep the phase
+                missed = int((now - self._t_next) / self.period)
+                self._t_next += missed * self.period
+                self.num_skipped += missed
+                self.num_overruns += 1
+            elif now > self._t_next:
+                self.num_overruns += 1
+
+            if self._t_next > now:
+                await asyncio.sleep(self._t_next - now)
+                now = time.monotonic()
+
+        jitter = now - self._t_next
+        self._jitter_sum += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        self.num_ticks += 1
+
+    @property
+    def jitter_mean(self):
+        return self._jitter_sum / self.num_ticks if self.num_ticks else math.nan
+
+    def __str__(self):
+        return "DeadlineTicker(%s,period=%.2fs,ticks=%d,overruns=%d,skipped=%d,jitter=%.3f/%.3fs)" % (
+            self.name,
+            self.period,
+            self.num_ticks,
+            self.num_overruns,
+            self.num_skipped,
+            self.jitter_mean,
+            self.jitter_max,
+        )
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing device after `failure_threshold` consecutive failures (the breaker opens). While open,
+    a single probe call is allowed after an exponentially growing, jittered back-off. A successful call closes the
+    breaker again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, backoff_base=5.0, backoff_max=300.0):
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.state = self.CLOSED
+        self.num_failures = 0
+        self.num_trips = 0
+        self._t_probe = 0.0
+
+    def allow(self) -> bool:
+        """
+        :return: True if the device should be called now
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.time() >= self._t_probe:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.num_failures = 0
+        self.num_trips = 0
+
+    def record_failure(self):
+        self.num_failures += 1
+        if self.state == self.HALF_OPEN or self.num_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.num_trips += 1
+            self._t_probe = time.time() + self.backoff()
+
+    def backoff(self) -> float:
+        """
+        :return: seconds to wait before the next probe
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** min(16, self.num_trips - 1))
+        return delay * random.uniform(0.75, 1.25)
+
+    def time_to_probe(self) -> float:
+        return max(0.0, self._t_probe - time.time())
+
+    @property
+    def is_open(self):
+        return self.state != self.CLOSED
+
+    def __str__(self):
+        return "CircuitBreaker(%s,failures=%d,trips=%d)" % (
+            self.state,
+            self.num_failures,
+            self.num_trips,
+        )
@@ -1,10 +1,11 @@
 import json
 import os.path
 import re
+import time
 from os import R_OK, access
 from os.path import isfile, join
 from threading import Lock
-from typing import Optional, Sequence
+from typing import Dict, Optional, Sequence
 
 from batmon.bmslib.util import dotdict, get_logger
 
@@ -13,6 +14,7 @@ logger = get_logger()
 lock = Lock()
 
 BMS_METER_STATES_FILENAME = "bms_meter_states.json"
+BT_DISCOVERY_CACHE_FILENAME = "bt_discovery_cache.json"
 
 root_dir: Optional[str] = None
 bms_meter_states: Optional[str] = None
@@ -48,6 +50,24 @@ def store_meter_states(meter_states):
             json.dump(meter_states, f)
 
 
+def load_discovery_cache(max_age: float) -> Dict[str, dict]:
+    """
+    Load devices seen in previous bluetooth discoveries, skipping entries older than max_age seconds.
+    :return: dict address -> dict(name=, adapter=, time=)
+    """
+    with lock:
+        with open(store_file(BT_DISCOVERY_CACHE_FILENAME)) as f:
+            devices = json.load(f)
+    t_min = time.time() - max_age
+    return {addr: d for addr, d in devices.items() if d.get("time", 0) >= t_min}
+
+
+def store_discovery_cache(devices: Dict[str, dict]):
+    with lock:
+        with open(store_file(BT_DISCOVERY_CACHE_FILENAME), "w") as f:
+            json.dump(devices, f)
+
+
 def store_algorithm_state(bms_name, algorithm_name, state=None):
     basename = "bat_state_" + re.sub(r"[^\w_. -]", "_", bms_name)
     with lock:
@@ -1,4 +1,5 @@
 import logging
+import re
 
 
 class dotdict(dict):
@@ -30,3 +31,13 @@ def get_logger(verbose=False):
 
 def dict_to_short_string(d: dict):
     return "(" + ",".join(f"{k}={v}" for k, v in d.items() if v is not None) + ")"
+
+
+def is_bt_address(s: str) -> bool:
+    """
+    :return: True if s is a bluetooth MAC address or a CoreBluetooth device UUID (macOS)
+    """
+    return bool(
+        re.match(r"^([0-9a-f]{2}:){5}[0-9a-f]{2}$", s, re.IGNORECASE)
+        or re.match(r"^[0-9a-f]{8}-([0-9a-f]{4}-){3}[0-9a-f]{12}$", s, re.IGNORECASE)
+    )
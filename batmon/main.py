@@ -7,52 +7,200 @@ import signal
 import sys
 import time
 import traceback
-from typing import Dict, List, Optional, Sequence
+from functools import partial
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Set
 
-import paho.mqtt.client as paho
-
-from batmon import mqtt_util
-
-import batmon.bmslib.bt
 import batmon.bmslib.store
-import batmon.bmslib.daly
-import batmon.bmslib.jbd
-import batmon.bmslib.jikong
-import batmon.bmslib.victron
-import batmon.bmslib.group
-import batmon.bmslib.dummy
 
+# drivers, bleak and paho are imported on demand, keep this module cheap to import (see registry.test_import_time)
 from batmon.bmslib.bms import MIN_VALUE_EXPIRY
-from batmon.bmslib.group import BmsGroup, VirtualGroupBms
-from batmon.bmslib.sampling import BmsSampler
+from batmon.bmslib.registry import BMS_REGISTRY, VIRTUAL_BMS_TYPES, load_bms_class
+from batmon.bmslib.scheduler import CircuitBreaker, DeadlineTicker
 from batmon.bmslib.store import load_user_config
-from batmon.bmslib.util import get_logger
-from batmon.mqtt_util import mqqt_last_publish_time, mqtt_message_handler, mqtt_process_action_queue
+from batmon.bmslib.util import get_logger, is_bt_address
+
+if TYPE_CHECKING:
+    from batmon.bmslib.bt import BtBms
+    from batmon.bmslib.group import BmsGroup
+    from batmon.bmslib.sampling import BmsSampler, SampleQueue
 
 logger = get_logger(verbose=False)
 shutdown = False
 
+# the event loop only keeps weak references to tasks, keep background tasks alive until they are done
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _background_task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Background task %s failed: %s", task.get_name(), task.exception())
+
+
+def create_background_task(coro, name=None) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
 
-async def fetch_loop(fn, period, max_errors):
-    num_errors_row = 0
+async def fetch_loop(fn, period, name=None):
+    ticker = DeadlineTicker(period, name=name or str(fn))
+    t_last_stats = time.time()
     while not shutdown:
+        await ticker.wait()
+        if shutdown:
+            break
         try:
             await fn()
-            num_errors_row = 0
         except Exception as e:
-            num_errors_row += 1
-            logger.error(
-                "Error (num %d, max %d) reading BMS: %s", num_errors_row, max_errors, e
-            )
+            logger.error("Error reading BMS: %s", e)
             logger.error("Stack: %s", traceback.format_exc())
-            if max_errors and num_errors_row > max_errors:
-                logger.warning("too many errors, abort")
-                break
-        await asyncio.sleep(period)
-    logger.info("fetch_loop %s ends", fn)
+        if time.time() - t_last_stats > 300:
+            t_last_stats = time.time()
+            logger.info("%s", ticker)
+    logger.info("fetch_loop %s ends (%s)", fn, ticker)
+
+
+async def publish_loop(queue: "SampleQueue"):
+    """
+    Publish the samples collected by the samplers to MQTT
+    """
+    from batmon import mqtt_util
 
+    t_last_stats = time.time()
+    while not shutdown:
+        record = await queue.get()
+        try:
+            record.sampler.publish(record)
+        except Exception as e:
+            logger.error("Error publishing %s: %s", record.sampler, e)
+            logger.error("Stack: %s", traceback.format_exc())
+        if time.time() - t_last_stats > 300:
+            t_last_stats = time.time()
+            logger.info("%s", queue)
+            logger.info(
+                "mqtt messages published %d, suppressed %d",
+                mqtt_util.num_published,
+                mqtt_util.num_suppressed,
+            )
+
+
+def sampler_lane(sampler) -> str:
+    """
+    :return: the lane of a sampler, which is the bluetooth adapter it uses. Virtual group BMS don't use the radio and
+     get a lane of their own.
+    """
+    from batmon.bmslib.group import VirtualGroupBms
+
+    bms = getattr(sampler, "bms", None)
+    if isinstance(bms, VirtualGroupBms):
+        return "virtual"
+    return (bms and bms.adapter) or "default"
+
+
+def sampler_lanes(samplers: list) -> Dict[str, list]:
+    """
+    Group samplers into lanes, one lane for each bluetooth adapter. Samplers sharing an adapter are read serially,
+    lanes are read in parallel.
+    """
+    lanes: Dict[str, list] = {}
+    for sampler in samplers:
+        lanes.setdefault(sampler_lane(sampler), []).append(sampler)
+    return lanes
+
+
+async def run_sampler(sampler, pending: Set, limit: Optional[asyncio.Semaphore]):
+    if sampler in pending:
+        # still warming up in the background
+        return
+    if limit is None:
+        return await sampler()
+    async with limit:
+        return await sampler()
+
+
+def serial_fetch(tasks: list, pending: Set, limit: Optional[asyncio.Semaphore]):
+    async def fn():
+        random.shuffle(tasks)
+        num_errors = 0
+        for t in tasks:
+            try:
+                await run_sampler(t, pending, limit)
+            except Exception:
+                # the sampler logged the error and its circuit breaker counted it
+                num_errors += 1
+        if num_errors:
+            logger.error("%d exceptions occurred fetching BMSs", num_errors)
+
+    return fn
+
+
+async def warm_up(
+    tasks: list, timeout: float, lane_limits: Dict[str, asyncio.Semaphore]
+) -> Set:
+    """
+    Connect to and sample each BMS once before the fetch loops start. BMSs are warmed up concurrently, bounded by
+    the per-adapter concurrency limit, and each one has `timeout` seconds to complete.
+    :return: set of samplers that failed or missed the deadline
+    """
+
+    async def warm(t):
+        limit = lane_limits.get(sampler_lane(t))
+        if limit is None:
+            return await asyncio.wait_for(t(), timeout)
+        async with limit:
+            return await asyncio.wait_for(t(), timeout)
+
+    t_start = time.time()
+    results = await asyncio.gather(*(warm(t) for t in tasks), return_exceptions=True)
+    pending = set()
+    for t, res in zip(tasks, results):
+        if isinstance(res, BaseException):
+            logger.warning(
+                "%s warm-up failed: %s", t, str(res) or type(res).__name__
+            )
+            pending.add(t)
+    logger.info(
+        "Warm-up of %d BMS took %.1fs, %d pending",
+        len(tasks),
+        time.time() - t_start,
+        len(pending),
+    )
+    return pending
+
+
+async def warm_up_retry(
+    t, pending: Set, timeout: float, limit: Optional[asyncio.Semaphore]
+):
+    """
+    Retry warming up a sampler in the background until it succeeds. The sampler joins its fetch loop afterwards.
+    """
+    attempt = 0
+    while not shutdown and t in pending:
+        await asyncio.sleep(min(60.0, 2.0**attempt))
+        attempt += 1
+        breaker = getattr(t, "breaker", None)
+        if breaker and breaker.is_open:
+            # the circuit breaker schedules further attempts within the fetch loop
+            pending.discard(t)
+            logger.info("%s warm-up failed, leaving retries to %s", t, breaker)
+            break
+        try:
+            if limit is None:
+                await asyncio.wait_for(t(), timeout)
+            else:
+                async with limit:
+                    await asyncio.wait_for(t(), timeout)
+            pending.discard(t)
+            logger.info("%s warm-up succeeded after %d retries", t, attempt)
+        except Exception as e:
+            logger.warning(
+                "%s warm-up retry %d failed: %s", t, attempt, str(e) or type(e).__name__
+            )
 
-def store_states(samplers: List[BmsSampler], no_store=False):
+
+def store_states(samplers: List["BmsSampler"], no_store=False):
     meter_states = {s.bms.name: s.get_meter_state() for s in samplers}
     from batmon.bmslib.store import store_meter_states
 
@@ -60,9 +208,11 @@ def store_states(samplers: List[BmsSampler], no_store=False):
         store_meter_states(meter_states)
 
 
-async def background_loop(timeout: float, sampler_list: List[BmsSampler], no_store=False):
+async def background_loop(timeout: float, sampler_list: List["BmsSampler"], no_store=False):
     global shutdown
 
+    from batmon.mqtt_util import mqqt_last_publish_time
+
     t_start = time.time()
     t_last_store = t_start
 
@@ -70,8 +220,6 @@ async def background_loop(timeout: float, sampler_list: List[BmsSampler], no_sto
         logger.info("mqtt watchdog loop started with timeout %.1fs", timeout)
 
     while not shutdown:
-
-        await mqtt_process_action_queue()
         now = time.time()
 
         if timeout:
@@ -96,11 +244,17 @@ async def background_loop(timeout: float, sampler_list: List[BmsSampler], no_sto
             except Exception as e:
                 logger.error("Error starting states: %s", e)
 
-        await asyncio.sleep(0.1)
+        await asyncio.sleep(1)
 
 
 async def main(user_config, no_store=False):
-    bms_list: List[batmon.bmslib.bt.BtBms] = []
+    import batmon.bmslib.bt
+    from batmon import mqtt_util
+    from batmon.mqtt_asyncio import AsyncioMqttClient
+    from batmon.bmslib.group import VirtualGroupBms
+    from batmon.bmslib.sampling import BmsSampler, SampleQueue
+
+    bms_list: List["BtBms"] = []
     extra_tasks = []
 
     if user_config.get("bt_power_cycle"):
@@ -113,26 +267,69 @@ async def main(user_config, no_store=False):
         except Exception as e:
             logger.warning("Error power cycling BT: %s", e)
 
-    devices = []
-    if not user_config.get("skip_discovery", False):
+    # address -> dict(name=, adapter=, time=)
+    known_devices: Dict[str, dict] = {}
+    discovery_ttl = float(user_config.get("discovery_cache_ttl", 24 * 3600))
+    if not no_store and discovery_ttl > 0:
         try:
-            devices = await batmon.bmslib.bt.bt_discovery(logger)
+            known_devices = batmon.bmslib.store.load_discovery_cache(max_age=discovery_ttl)
+            logger.info("Loaded %d devices from discovery cache", len(known_devices))
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            logger.error("Error discovering devices: %s", e)
-    else:
-        logger.info("Skipping discovery phase on user request")
-
+            logger.warning("Failed to load discovery cache: %s", e)
 
     def name2addr(name: str):
+        name = name.strip()
         return next(
-            (d.address for d in devices if (d.name or "").strip() == name.strip()), name
+            (
+                addr
+                for addr, d in known_devices.items()
+                if (d["name"] or "").strip() == name or addr.lower() == name.lower()
+            ),
+            name,
         )
 
-    def dev_by_addr(address: str):
-        dev = next((d for d in devices if d.address == address), None)
-        if not dev:
+    def name_by_addr(address: str):
+        if address not in known_devices:
             raise Exception("Can't resolve device name %s, not discovered" % address)
-        return dev
+        return known_devices[address]["name"]
+
+    bt_devices = [
+        dev
+        for dev in user_config.get("devices", [])
+        if dev["address"]
+        and not dev["address"].startswith("#")
+        and not dev["address"].startswith("test_")
+        and dev["type"] not in VIRTUAL_BMS_TYPES
+    ]
+
+    # one scanner per adapter for the process lifetime, discovery and connect() use its presence table
+    for adapter in set(dev.get("adapter") for dev in bt_devices):
+        try:
+            await batmon.bmslib.bt.SharedScanner.get(adapter).start()
+        except Exception as e:
+            logger.warning("Failed to start scanner (%s): %s", adapter or "default adapter", e)
+
+    # look for devices we haven't seen yet, on their adapters
+    scan_wanted: Dict[Optional[str], Set[str]] = {}
+    for dev in bt_devices:
+        addr = dev["address"]
+        if is_bt_address(addr) and dev.get("alias"):
+            # connects by address, the name is only needed without an alias
+            continue
+        if name2addr(addr) not in known_devices:
+            scan_wanted.setdefault(dev.get("adapter"), set()).add(addr)
+
+    discovery_timeout = float(user_config.get("discovery_timeout", 10))
+    if not scan_wanted:
+        logger.info("All devices configured by address or found in discovery cache, skipping discovery")
+    elif user_config.get("skip_discovery", False):
+        logger.info("Skipping discovery phase on user request")
+        scan_wanted = {}
+
+    # devices the scan looks for are added while it runs, as soon as they are found (see discover() below)
+    awaited = [dev for dev in bt_devices if dev["address"] in scan_wanted.get(dev.get("adapter"), ())]
 
     verbose_log = user_config.get("verbose_log", False)
     if verbose_log:
@@ -144,75 +341,74 @@ async def main(user_config, no_store=False):
         batmon.bmslib.bt.bt_stack_version(),
     )
 
-    bms_registry = dict(
-        daly=batmon.bmslib.daly.DalyBt,
-        jbd=batmon.bmslib.jbd.JbdBt,
-        jk=batmon.bmslib.jikong.JKBt,
-        victron=batmon.bmslib.victron.SmartShuntBt,
-        group_parallel=batmon.bmslib.group.VirtualGroupBms,
-        # group_serial=bmslib.group.VirtualGroupBms, # TODO
-        dummy=batmon.bmslib.dummy.DummyBt,
-    )
-
     names = set()
     dev_args: Dict[str, dict] = {}
+    bms_by_name: Dict[str, "BtBms"] = {}  # by address and name
+    groups_by_bms: Dict[str, "BmsGroup"] = {}
+    # groups with members that were not found yet
+    incomplete_groups: List[VirtualGroupBms] = []
+    samplers_by_name: Dict[str, "BmsSampler"] = {}
 
-    for dev in user_config.get("devices", []):
+    def create_bms(dev: dict) -> Optional["BtBms"]:
         addr: str = dev["address"]
 
-        if not addr or addr.startswith("#"):
-            continue
-
-        if dev["type"] not in bms_registry:
+        if dev["type"] not in BMS_REGISTRY:
             logger.warning("Unknown device type %s", dev)
-            continue
+            return None
 
-        bms_class = bms_registry[dev["type"]]
+        bms_class = load_bms_class(dev["type"])
         if dev.get("debug"):
             logger.info("Verbose log for %s enabled", addr)
         addr = name2addr(addr)
-        name: str = dev.get("alias") or dev_by_addr(addr).name
+        name: str = dev.get("alias") or name_by_addr(addr)
         assert name not in names, "duplicate name %s" % name
-        bms_list.append(
-            bms_class(
-                addr,
-                name=name,
-                verbose_log=verbose_log or dev.get("debug"),
-                psk=dev.get("pin"),
-                adapter=dev.get("adapter"),
-            )
+        bms = bms_class(
+            addr,
+            name=name,
+            verbose_log=verbose_log or dev.get("debug"),
+            psk=dev.get("pin"),
+            adapter=dev.get("adapter"),
         )
+        bms.set_keep_alive(user_config.get("keep_alive", False))
+        bms_list.append(bms)
         names.add(name)
         dev_args[name] = dev
+        if not isinstance(bms, VirtualGroupBms):
+            bms_by_name.setdefault(bms.address, bms)
+        bms_by_name[bms.name] = bms
+        return bms
+
+    def link_members(group_bms: VirtualGroupBms) -> bool:
+        """
+        Add the members created so far to the group.
+        :return: True if all members were added
+        """
+        for member_ref in group_bms.get_member_refs():
+            member = bms_by_name.get(member_ref)
+            if member is None or member in group_bms.members:
+                continue
+            if member.name in groups_by_bms:
+                raise Exception(
+                    "can't add bms %s to multiple groups %s %s"
+                    % (member.name, groups_by_bms[member.name], group_bms)
+                )
+            groups_by_bms[member.name] = group_bms.group
+            group_bms.add_member(member)
+            if member.name in samplers_by_name:
+                samplers_by_name[member.name].bms_group = group_bms.group
+        return len(group_bms.members) == len(group_bms.get_member_refs())
 
-    bms_by_name: Dict[str, batmon.bmslib.bt.BtBms] = {
-        **{
-            bms.address: bms for bms in bms_list if not isinstance(bms, VirtualGroupBms)
-        },
-        **{bms.name: bms for bms in bms_list},
-    }
-    groups_by_bms: Dict[str, BmsGroup] = {}
+    for dev in user_config.get("devices", []):
+        if not dev["address"] or dev["address"].startswith("#") or dev in awaited:
+            continue
+        create_bms(dev)
 
     for bms in bms_list:
-        bms.set_keep_alive(user_config.get("keep_alive", False))
-
-        if isinstance(bms, VirtualGroupBms):
-            group_bms = bms
-            for member_ref in bms.get_member_refs():
-                if member_ref not in bms_by_name:
-                    raise Exception(
-                        "unknown bms %s in group %s" % (member_ref, group_bms)
-                    )
-                member_name = bms_by_name[member_ref].name
-                if member_name in groups_by_bms:
-                    raise Exception(
-                        "can't add bms %s to multiple groups %s %s",
-                        member_name,
-                        groups_by_bms[member_name],
-                        group_bms,
-                    )
-                groups_by_bms[member_name] = group_bms.group
-                bms.add_member(bms_by_name[member_ref])
+        if isinstance(bms, VirtualGroupBms) and not link_members(bms):
+            if not awaited:
+                unknown = bms.get_member_refs() - set(bms_by_name.keys())
+                raise Exception("unknown bms %s in group %s" % (unknown, bms))
+            incomplete_groups.append(bms)
 
     port_idx = user_config.mqtt_broker.rfind(":")
     if port_idx > 0:
@@ -223,22 +419,22 @@ async def main(user_config, no_store=False):
 
     logger.info("connecting mqtt %s@%s", user_config.mqtt_user, user_config.mqtt_broker)
     # paho_monkey_patch()
-    mqtt_client = paho.Client()
+    mqtt_client = AsyncioMqttClient()
     mqtt_client.enable_logger(logger)
     if user_config.get("mqtt_user", None):
         mqtt_client.username_pw_set(user_config.mqtt_user, user_config.mqtt_password)
 
-    mqtt_client.on_message = mqtt_message_handler
+    mqtt_client.on_message = mqtt_util.mqtt_message_handler
+    mqtt_util.subscribe_hass_status(mqtt_client)
 
-    try:
-        mqtt_client.connect(
-            user_config.mqtt_broker, port=user_config.get("mqtt_port", 1883)
+    if user_config.mqtt_broker:
+        # connects in the background and reconnects if the connection is lost
+        create_background_task(
+            mqtt_client.run(user_config.mqtt_broker, port=user_config.get("mqtt_port", 1883)),
+            name="mqtt",
         )
-        mqtt_client.loop_start()
-    except Exception as ex:
-        logger.error("mqtt connection error %s", ex)
-
-    if not user_config.mqtt_broker:
+    else:
+        logger.error("mqtt connection error: no mqtt_broker configured")
         mqtt_util.disable_warnings()
 
     from batmon.bmslib.store import load_meter_states
@@ -262,9 +458,24 @@ async def main(user_config, no_store=False):
     expire_values_after = float(
         user_config.get("expire_values_after", MIN_VALUE_EXPIRY)
     )
+    mqtt_heartbeat = float(user_config.get("mqtt_heartbeat", MIN_VALUE_EXPIRY / 2))
+    if mqtt_heartbeat >= expire_values_after:
+        logger.warning(
+            "mqtt_heartbeat %.1fs >= expire_values_after %.1fs, Home Assistant will expire unchanged values",
+            mqtt_heartbeat,
+            expire_values_after,
+        )
+    mqtt_util.set_deadbands(
+        mqtt_util.parse_deadbands(user_config.get("mqtt_deadbands", "")), heartbeat=mqtt_heartbeat
+    )
     ic = user_config.get("invert_current", False)
-    sampler_list = [
-        BmsSampler(
+    sample_queue = SampleQueue(
+        maxsize=int(user_config.get("publish_queue_size", 32)),
+        policy=user_config.get("publish_queue_policy", SampleQueue.COALESCE),
+    )
+
+    def create_sampler(bms) -> BmsSampler:
+        sampler = BmsSampler(
             bms,
             mqtt_client=mqtt_client,
             dt_max_seconds=max(4.0, sample_period * 2),
@@ -282,9 +493,20 @@ async def main(user_config, no_store=False):
                 "current_correction_factor", 1.0
             ),
             bms_group=groups_by_bms.get(bms.name),
+            breaker=CircuitBreaker(
+                failure_threshold=int(user_config.get("breaker_failures", 5)),
+                backoff_base=max(5.0, sample_period),
+                backoff_max=float(user_config.get("breaker_backoff_max", 300)),
+            ),
+            sample_queue=sample_queue,
+            push_mode=user_config.get("push_sampling", False),
+            stream_meters=user_config.get("stream_meters", False),
+            json_payload=user_config.get("mqtt_payload", "topics") == "json",
         )
-        for bms in bms_list
-    ]
+        samplers_by_name[bms.name] = sampler
+        return sampler
+
+    sampler_list = [create_sampler(bms) for bms in bms_list if bms not in incomplete_groups]
 
     # move groups to the end
     sampler_list = sorted(
@@ -293,73 +515,174 @@ async def main(user_config, no_store=False):
 
     parallel_fetch = user_config.get("concurrent_sampling", False)
 
+    # serial fetch within each bluetooth adapter lane, lanes run in parallel. lanes of devices the scan still looks
+    # for start empty
+    lanes = sampler_lanes(sampler_list)
+    if extra_tasks:
+        lanes.setdefault("default", []).extend(extra_tasks)
+    for dev in awaited:
+        lanes.setdefault(dev.get("adapter") or "default", [])
+    if incomplete_groups:
+        lanes.setdefault("virtual", [])
+
     logger.info(
-        "Fetching %d BMS + %d others %s, period=%.2fs, keep_alive=%s",
+        "Fetching %d BMS + %d others %s, period=%.2fs, keep_alive=%s, %d awaiting discovery",
         len(sampler_list),
         len(extra_tasks),
-        "concurrently" if parallel_fetch else "serially",
+        "concurrently" if parallel_fetch else "serially (lanes %s)" % ", ".join(lanes.keys()),
         sample_period,
         user_config.get("keep_alive", False),
+        len(awaited),
     )
 
     watchdog_en = user_config.get("watchdog", False)
-    max_errors = 200 if watchdog_en else 0
 
-    asyncio.create_task(
+    create_background_task(
         background_loop(
             timeout=max(15 * 60.0, sample_period * 4) if watchdog_en else 0,
             sampler_list=sampler_list, no_store=no_store
-        )
+        ),
+        name="background_loop",
     )
 
-    tasks = sampler_list + extra_tasks
+    create_background_task(publish_loop(sample_queue), name="publish_loop")
 
-    # before we start the loops connect to each bms
-    for t in tasks:
-        try:
-            await t()
-        except:
-            pass
+    tasks = sampler_list + extra_tasks
 
-    if parallel_fetch:
-        # parallel_fetch now uses a loop for each BMS so they don't delay each other
+    # limit concurrent BLE operations on each adapter. with concurrent_sampling there is no limit by default
+    adapter_concurrency = int(
+        user_config.get("adapter_concurrency", 0 if parallel_fetch else 1)
+    )
+    lane_limits: Dict[str, asyncio.Semaphore] = {
+        lane: asyncio.Semaphore(adapter_concurrency)
+        for lane in lanes.keys()
+        if adapter_concurrency > 0 and lane != "virtual"
+    }
 
-        loops = [
-            asyncio.create_task(
-                fetch_loop(fn, period=sample_period, max_errors=max_errors)
+    warmup_timeout = float(user_config.get("warmup_timeout", 20))
+    # samplers that are warming up in the background, the fetch loops skip them
+    pending: Set = set()
+    loops: List[asyncio.Task] = []
+
+    def parallel_fetch_loop(fn) -> asyncio.Task:
+        return asyncio.create_task(
+            fetch_loop(
+                partial(run_sampler, fn, pending, lane_limits.get(sampler_lane(fn))),
+                period=sample_period,
+                name=str(fn),
             )
-            for fn in tasks
-        ]
-        await asyncio.wait(loops, return_when="FIRST_COMPLETED")
+        )
 
-    else:
+    def add_sampler(bms):
+        sampler = create_sampler(bms)
+        sampler_list.append(sampler)
+        lane = sampler_lane(sampler)
+        pending.add(sampler)
+        if parallel_fetch:
+            loops.append(parallel_fetch_loop(sampler))
+        else:
+            lanes[lane].append(sampler)
+        create_background_task(
+            warm_up_retry(sampler, pending, timeout=warmup_timeout, limit=lane_limits.get(lane)),
+            name="warm_up %s" % sampler,
+        )
 
-        async def fn():
-            if parallel_fetch:
-                # concurrent synchronised fetch
-                # this branch is currently not reachable!
-                await asyncio.gather(*[t() for t in tasks], return_exceptions=False)
-            else:
-                random.shuffle(tasks)
-                exceptions = []
-                for t in tasks:
+    def add_found_device(dev: dict):
+        bms = create_bms(dev)
+        if bms is None:
+            return
+        add_sampler(bms)
+        for group_bms in list(incomplete_groups):
+            if link_members(group_bms):
+                incomplete_groups.remove(group_bms)
+                add_sampler(group_bms)
+
+    async def scan(adapter, wanted):
+        async for d in batmon.bmslib.bt.bt_discovery_stream(
+            logger, wanted, timeout=discovery_timeout, adapter=adapter
+        ):
+            known_devices[d.address] = dict(name=d.name, adapter=adapter, time=time.time())
+            for dev in [dev for dev in awaited if dev.get("adapter") == adapter]:
+                if name2addr(dev["address"]) in known_devices:
+                    awaited.remove(dev)
                     try:
-                        await t()
-                    except Exception as ex:
-                        exceptions.append(ex)
-                if exceptions:
-                    logger.error(
-                        "%d exceptions occurred fetching BMSs", len(exceptions)
-                    )
-                    raise exceptions[0]
+                        add_found_device(dev)
+                    except Exception as e:
+                        logger.error("Error adding device %s: %s", dev["address"], e)
+
+    async def discover():
+        """
+        Scan for the awaited devices while the samplers of the other devices already run, and start the sampler of
+        each device as soon as it is found. The scans end as soon as all wanted devices are seen.
+        """
+        results = await asyncio.gather(
+            *(scan(adapter, wanted) for adapter, wanted in scan_wanted.items()),
+            return_exceptions=True,
+        )
+        for res in results:
+            if isinstance(res, Exception):
+                logger.error("Error discovering devices: %s", res)
+        if not no_store:
+            try:
+                batmon.bmslib.store.store_discovery_cache(known_devices)
+            except Exception as e:
+                logger.warning("Failed to store discovery cache: %s", e)
+
+        # not found, try to connect anyway
+        for dev in list(awaited):
+            awaited.remove(dev)
+            try:
+                add_found_device(dev)
+            except Exception as e:
+                logger.error("Error adding device %s: %s", dev["address"], e)
+        for group_bms in incomplete_groups:
+            unknown = group_bms.get_member_refs() - set(bms_by_name.keys())
+            logger.error("unknown bms %s in group %s", unknown, group_bms)
+
+    if awaited:
+        create_background_task(discover(), name="discovery")
+
+    # before we start the loops connect to each bms
+    failed = await warm_up(tasks, timeout=warmup_timeout, lane_limits=lane_limits)
+    pending.update(failed)
+    for t in failed:
+        create_background_task(
+            warm_up_retry(
+                t, pending, timeout=warmup_timeout, limit=lane_limits.get(sampler_lane(t))
+            ),
+            name="warm_up_retry %s" % t,
+        )
 
-        await fetch_loop(fn, period=sample_period, max_errors=max_errors)
+    if parallel_fetch:
+        # parallel_fetch now uses a loop for each BMS so they don't delay each other
+        loops.extend(parallel_fetch_loop(fn) for fn in tasks)
+    else:
+        loops.extend(
+            asyncio.create_task(
+                fetch_loop(
+                    serial_fetch(lane_tasks, pending, lane_limits.get(lane)),
+                    period=sample_period,
+                    name="lane-%s" % lane,
+                )
+            )
+            for lane, lane_tasks in lanes.items()
+        )
 
     global shutdown
+    # with concurrent_sampling, loops of devices found later are added while waiting
+    while not any(loop.done() for loop in loops):
+        if loops:
+            await asyncio.wait(list(loops), timeout=1, return_when="FIRST_COMPLETED")
+        elif shutdown:
+            break
+        else:
+            await asyncio.sleep(1)
+
     logger.info("All fetch loops ended. shutdown is already %s", shutdown)
     shutdown = True
 
 
+    logger.info("%s", sample_queue)
     store_states(sampler_list, no_store=no_store)
 
     for bms in bms_list:
@@ -370,6 +693,11 @@ async def main(user_config, no_store=False):
         except:
             pass
 
+    try:
+        await batmon.bmslib.bt.SharedScanner.stop_all()
+    except Exception as e:
+        logger.warning("Error stopping scanner: %s", e)
+
 
 def on_exit(*args, **kwargs):
     global shutdown
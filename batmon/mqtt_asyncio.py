@@ -0,0 +1,235 @@
+"""
+paho MQTT client driven by the asyncio event loop, instead of paho's network thread (loop_start()).
+
+The socket is registered with the event loop, so incoming messages and all paho callbacks run on the event loop thread
+and can start coroutines directly. Connecting runs in an executor and does not block the event loop, a lost connection
+is re-established with exponential back-off and subscriptions are renewed.
+
+    client = AsyncioMqttClient()
+    asyncio.create_task(client.run("core-mosquitto", 1883))
+    await client.publish_async("topic", "payload", qos=1)
+
+"""
+import asyncio
+import threading
+from typing import Dict, Optional
+
+import paho.mqtt.client as paho
+
+from batmon.bmslib.correlator import RequestCorrelator
+from batmon.bmslib.util import get_logger
+
+logger = get_logger()
+
+
+class AsyncioMqttClient(paho.Client):
+    RECONNECT_MIN = 1.0
+    RECONNECT_MAX = 60.0
+    MISC_PERIOD = 1.0  # keep-alive pings and timeouts
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._event_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._event_loop_thread = None
+        self._closed: Optional[asyncio.Future] = None
+        self._subscriptions: Dict[str, int] = {}
+        self._acks = RequestCorrelator()
+        self.connected = False
+        self.reconnect_delay = self.RECONNECT_MIN
+
+        self.on_socket_open = self._loop_socket_open
+        self.on_socket_close = self._loop_socket_close
+        self.on_socket_register_write = self._loop_register_write
+        self.on_socket_unregister_write = self._loop_unregister_write
+        self.on_connect = self._connect_done
+        self.on_disconnect = self._disconnect_done
+        self.on_publish = self._publish_done
+
+    def _call(self, fn, *args):
+        # socket callbacks are called from the executor thread while connecting
+        if threading.get_ident() == self._event_loop_thread:
+            fn(*args)
+        else:
+            self._event_loop.call_soon_threadsafe(fn, *args)
+
+    def _loop_socket_open(self, client, userdata, sock):
+        self._call(self._event_loop.add_reader, sock, self.loop_read)
+
+    def _loop_socket_close(self, client, userdata, sock):
+        self._call(self._socket_closed, sock)
+
+    def _socket_closed(self, sock):
+        self._event_loop.remove_reader(sock)
+        if self._closed and not self._closed.done():
+            self._closed.set_result(None)
+
+    def _loop_register_write(self, client, userdata, sock):
+        self._call(self._event_loop.add_writer, sock, self.loop_write)
+
+    def _loop_unregister_write(self, client, userdata, sock):
+        self._call(self._event_loop.remove_writer, sock)
+
+    def _connect_done(self, client, userdata, flags, rc):
+        if rc != paho.CONNACK_ACCEPTED:
+            logger.error("mqtt connection refused: %s", paho.connack_string(rc))
+            return
+        logger.info("mqtt connected")
+        self.connected = True
+        self.reconnect_delay = self.RECONNECT_MIN
+        if self._subscriptions:
+            super().subscribe(list(self._subscriptions.items()))
+
+    def _disconnect_done(self, client, userdata, rc):
+        self.connected = False
+        self._acks.cancel_all("mqtt disconnected")
+
+    def _publish_done(self, client, userdata, mid):
+        self._acks.set_result(mid, mid)
+
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        """
+        Subscriptions are renewed after a reconnect
+        """
+        self._subscriptions[topic] = qos
+        if not self.connected:
+            return paho.MQTT_ERR_NO_CONN, None
+        return super().subscribe(topic, qos, options, properties)
+
+    async def publish_async(self, topic, payload=None, qos=1, retain=False, timeout=10.0):
+        """
+        Publish and wait until the broker acknowledged the message (qos 1 and 2) or it was written to the socket
+        (qos 0). Raises ConnectionError if the message can't be sent and asyncio.TimeoutError.
+        """
+        info = self.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc != paho.MQTT_ERR_SUCCESS:
+            raise ConnectionError(paho.error_string(info.rc))
+        if info.is_published():
+            return
+        # on_publish() runs on the event loop, so it can't complete before we wait
+        async with self._acks.request(info.mid) as req:
+            await req.wait(timeout)
+
+    async def _misc_loop(self):
+        while True:
+            await asyncio.sleep(self.MISC_PERIOD)
+            self.loop_misc()
+
+    async def run(self, host, port=1883, keepalive=60):
+        """
+        Connect and keep the connection, until cancelled
+        """
+        self._event_loop = asyncio.get_running_loop()
+        self._event_loop_thread = threading.get_ident()
+        self.connect_async(host, port, keepalive)
+        misc = asyncio.ensure_future(self._misc_loop())
+        try:
+            while True:
+                self._closed = self._event_loop.create_future()
+                try:
+                    await self._event_loop.run_in_executor(None, self.reconnect)
+                except Exception as e:
+                    logger.error(
+                        "mqtt connection error %s, retry in %.0fs", e, self.reconnect_delay
+                    )
+                else:
+                    await self._closed
+                    logger.warning("mqtt connection lost, retry in %.0fs", self.reconnect_delay)
+                await asyncio.sleep(self.reconnect_delay)
+                self.reconnect_delay = min(self.reconnect_delay * 2, self.RECONNECT_MAX)
+        finally:
+            misc.cancel()
+            if self.socket():
+                self.disconnect()
+
+
+class _TestBroker:
+    """
+    Just enough of an MQTT 3.1.1 broker for test_asyncio_mqtt_client(): acknowledges connect, subscribe and qos 1
+    publish, and sends a message to the client for each subscription
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.published = []
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self.writer = writer
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, mult = 0, 1
+                while True:
+                    b = (await reader.readexactly(1))[0]
+                    length += (b & 0x7F) * mult
+                    mult *= 128
+                    if not b & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                cmd = header & 0xF0
+                if cmd == paho.CONNECT:
+                    writer.write(bytes([paho.CONNACK, 2, 0, 0]))
+                elif cmd == paho.PUBLISH:
+                    n = int.from_bytes(body[:2], "big")
+                    topic = body[2 : 2 + n].decode()
+                    qos = (header >> 1) & 3
+                    payload = body[2 + n + (2 if qos else 0) :]
+                    self.published.append((topic, payload.decode()))
+                    if qos:
+                        writer.write(bytes([paho.PUBACK, 2]) + body[2 + n : 4 + n])
+                elif cmd == paho.SUBSCRIBE:
+                    writer.write(bytes([paho.SUBACK, 3]) + body[:2] + b"\x00")
+                    n = int.from_bytes(body[2:4], "big")
+                    topic = body[4 : 4 + n]
+                    msg = len(topic).to_bytes(2, "big") + topic + b"online"
+                    writer.write(bytes([paho.PUBLISH, len(msg)]) + msg)
+                elif cmd == paho.PINGREQ:
+                    writer.write(bytes([paho.PINGRESP, 0]))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+
+def test_asyncio_mqtt_client():
+    async def run():
+        broker = _TestBroker()
+        server = await asyncio.start_server(broker.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        client = AsyncioMqttClient()
+        client.RECONNECT_MIN = 0.01
+        received = []
+        client.on_message = lambda c, u, msg: received.append((msg.topic, threading.get_ident()))
+        client.subscribe("homeassistant/status")
+        task = asyncio.ensure_future(client.run("127.0.0.1", port))
+
+        async def until(cond):
+            for _ in range(200):
+                if cond():
+                    return
+                await asyncio.sleep(0.01)
+            assert False, "timeout"
+
+        await until(lambda: received)
+        # on the event loop thread
+        assert received == [("homeassistant/status", threading.get_ident())]
+
+        await client.publish_async("bat/soc/current", "1.5", qos=1)
+        await client.publish_async("bat/soc/power", "80", qos=0)  # written, the broker may not have read it yet
+        await until(lambda: len(broker.published) == 2)
+        assert broker.published == [("bat/soc/current", "1.5"), ("bat/soc/power", "80")]
+
+        # reconnect and subscribe again
+        broker.writer.close()
+        await until(lambda: len(received) == 2)
+        assert broker.connections == 2 and client.connected
+
+        task.cancel()
+        server.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_asyncio_mqtt_client()
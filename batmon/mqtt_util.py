@@ -1,9 +1,11 @@
+import asyncio
+import hashlib
 import json
 import math
-import queue
-import statistics
 import time
 import traceback
+from functools import lru_cache
+from typing import Dict, NamedTuple, Optional
 
 import paho.mqtt.client as paho
 
@@ -32,6 +34,19 @@ def round_to_n(x, n):
         raise e
 
 
+def round_to_n_value(x, n):
+    """
+    Like round_to_n(), but returns a number for JSON payloads. None for NaN and infinite values.
+    """
+    if x is None or isinstance(x, (str, bool)):
+        return x
+    if not math.isfinite(x):
+        return None
+    if not x:
+        return x
+    return round(x, -int(math.floor(math.log10(abs(x)))) + (n - 1))
+
+
 def disable_warnings():
     global no_publish_fail_warn
     no_publish_fail_warn = True
@@ -98,19 +113,89 @@ def build_mqtt_hass_config_discovery(base, topic):
     return hass_config_topic, json.dumps(hass_config_data)
 
 
+class Deadband(NamedTuple):
+    """
+    A value is only published if it differs from the last published value by more than `abs` or `rel` * last value
+    """
+
+    abs: float = 0.0
+    rel: float = 0.0
+
+    def exceeded(self, last, value) -> bool:
+        try:
+            last, value = float(last), float(value)
+        except (TypeError, ValueError):
+            return last != value
+        if not (math.isfinite(last) and math.isfinite(value)):
+            return last != value
+        d, limit = abs(value - last), max(self.abs, self.rel * abs(last))
+        return d > limit and not math.isclose(d, limit)  # ignore float error of values at the limit
+
+
+_deadbands: Dict[str, Deadband] = {}
+
+# unchanged values are published again after this many seconds, so Home Assistant `expire_after` doesn't make them
+# unavailable
+_heartbeat = MIN_VALUE_EXPIRY / 2
+
+
+def parse_deadbands(spec: str) -> Dict[str, Deadband]:
+    """
+    Parse deadbands from a comma separated list of `key=value`. A value with % is relative, otherwise absolute.
+    Keys are the topic names below the device topic, a key without index applies to all of them:
+    `soc/current=0.05,soc/power=2%,cell_voltages=0.002,temperatures=0.5`
+    """
+    deadbands = {}
+    for item in filter(None, map(str.strip, (spec or "").split(","))):
+        key, value = map(str.strip, item.split("="))
+        if value.endswith("%"):
+            deadbands[key] = Deadband(rel=float(value[:-1]) / 100)
+        else:
+            deadbands[key] = Deadband(abs=float(value))
+    return deadbands
+
+
+def set_deadbands(deadbands: Dict[str, Deadband], heartbeat: Optional[float] = None):
+    global _heartbeat
+    _deadbands.clear()
+    _deadbands.update(deadbands)
+    deadband_for.cache_clear()
+    if heartbeat is not None:
+        _heartbeat = heartbeat
+
+
+@lru_cache(maxsize=None)
+def deadband_for(key: str) -> Optional[Deadband]:
+    """
+    :param key: topic name below the device topic, e.g. `soc/current` or `cell_voltages/3`
+    """
+    db = _deadbands.get(key)
+    if db is None and "/" in key:
+        db = _deadbands.get(key.rsplit("/", 1)[0])
+    return db
+
+
 _last_values = {}
 _last_publish_time = 0.0
+num_published = 0
+num_suppressed = 0
 
 
-def mqtt_single_out(client: paho.Client, topic, data, retain=False):
+def mqtt_single_out(
+    client: paho.Client, topic, data, retain=False, deadband: Optional[Deadband] = None
+):
     # logger.debug(f'Send data: {data} on topic: {topic}, retain flag: {retain}')
     # print('mqtt: ' + topic, data)
     # return
+    global num_published, num_suppressed
 
+    now = time.time()
     lv = _last_values.get(topic, None)
-    if lv and lv[1] == data and (time.time() - lv[0]) < (MIN_VALUE_EXPIRY / 2):
-        logger.debug("topic %s data not changed", topic)
-        return False
+    if lv and (now - lv[0]) < _heartbeat:
+        if lv[1] == data or (deadband and not deadband.exceeded(lv[1], data)):
+            logger.debug("topic %s data not changed", topic)
+            num_suppressed += 1
+            return False
 
     mqi: paho.MQTTMessageInfo = client.publish(topic, data, retain=retain)
     if mqi.rc != paho.MQTT_ERR_SUCCESS:
@@ -118,10 +203,10 @@ def mqtt_single_out(client: paho.Client, topic, data, retain=False):
             logger.warning("mqtt publish %s failed: %s %s", topic, mqi.rc, mqi)
         return False
 
-    now = time.time()
     _last_values[topic] = now, data
     global _last_publish_time
     _last_publish_time = now
+    num_published += 1
 
 
 def mqqt_last_publish_time():
@@ -246,7 +331,7 @@ def publish_sample(client, device_topic, sample: BmsSample):
     for k, v in sample_desc.items():
         topic = f"{device_topic}/{k}"
         s = round_to_n(getattr(sample, v["field"]), v.get("precision", 5))
-        mqtt_single_out(client, topic, s)
+        mqtt_single_out(client, topic, s, deadband=deadband_for(k))
 
     if sample.switches:
         for switch_name, switch_state in sample.switches.items():
@@ -254,50 +339,210 @@ def publish_sample(client, device_topic, sample: BmsSample):
             mqtt_single_out(client, topic, "ON" if switch_state else "OFF")
 
 
-def publish_cell_voltages(client, device_topic, voltages):
+def cell_voltage_values(voltages) -> Dict[str, float]:
+    """
+    :param voltages: cell voltages in mV
+    :return: topic -> value in V, for each cell and the cell statistics
+    """
     # "highest_voltage": parts[0] / 1000,
     # "highest_cell": parts[1],
     # "lowest_voltage": parts[2] / 1000,
     # "lowest_cell": parts[3],
 
-    if not voltages:
-        return
+    values = {f"cell_voltages/{i + 1}": voltages[i] / 1000 for i in range(len(voltages))}
+    values.update(zip(CELL_STATS, cell_stats(voltages)))
+    return values
 
-    x = range(len(voltages))
-    high_i = max(x, key=lambda i: voltages[i])
-    low_i = min(x, key=lambda i: voltages[i])
 
-    for i in range(0, len(voltages)):
-        topic = f"{device_topic}/cell_voltages/{i + 1}"
-        mqtt_single_out(client, topic, voltages[i] / 1000)
+CELL_STATS = tuple(
+    "cell_voltages/" + s
+    for s in ("min", "min_index", "max", "max_index", "delta", "average", "median")
+)
 
-    mqtt_single_out(client, f"{device_topic}/cell_voltages/min", voltages[low_i] / 1000)
-    mqtt_single_out(client, f"{device_topic}/cell_voltages/min_index", low_i)
-    mqtt_single_out(
-        client, f"{device_topic}/cell_voltages/max", voltages[high_i] / 1000
-    )
-    mqtt_single_out(client, f"{device_topic}/cell_voltages/max_index", high_i)
-    mqtt_single_out(
-        client,
-        f"{device_topic}/cell_voltages/delta",
-        (voltages[high_i] - voltages[low_i]) / 1000,
-    )
-    mqtt_single_out(
-        client,
-        f"{device_topic}/cell_voltages/average",
-        round(sum(voltages) / len(voltages)) / 1000,
-    )
-    mqtt_single_out(
-        client,
-        f"{device_topic}/cell_voltages/median",
-        statistics.median(voltages) / 1000,
+
+def cell_stats(voltages) -> tuple:
+    """
+    :param voltages: cell voltages in mV
+    :return: values of CELL_STATS, voltages in V
+    """
+    low, high = min(voltages), max(voltages)
+    n = len(voltages)
+    s = sorted(voltages)
+    median = s[n // 2] if n % 2 else (s[n // 2 - 1] + s[n // 2]) / 2  # same as statistics.median()
+    return (
+        low / 1000,
+        voltages.index(low),
+        high / 1000,
+        voltages.index(high),
+        (high - low) / 1000,
+        round(sum(voltages) / n) / 1000,
+        median / 1000,
     )
 
 
+def publish_cell_voltages(client, device_topic, voltages):
+    if not voltages:
+        return
+
+    for k, v in cell_voltage_values(voltages).items():
+        mqtt_single_out(client, f"{device_topic}/{k}", v, deadband=deadband_for(k))
+
+
 def publish_temperatures(client, device_topic, temperatures):
     for i in range(0, len(temperatures)):
-        topic = f"{device_topic}/temperatures/{i + 1}"
-        mqtt_single_out(client, topic, round_to_n(temperatures[i], 4))
+        k = f"temperatures/{i + 1}"
+        mqtt_single_out(
+            client, f"{device_topic}/{k}", round_to_n(temperatures[i], 4), deadband=deadband_for(k)
+        )
+
+
+class _Rounder:
+    """
+    round_to_n() for the values of one field. The number of decimal digits only changes with the magnitude of the
+    value, so it is kept for values within the decade of the previous value, saving the log10().
+    """
+
+    __slots__ = ("n", "lo", "hi", "digits", "fmt")
+
+    def __init__(self, n):
+        self.n = n
+        self.lo = self.hi = 0.0
+        self.digits = None
+        self.fmt = None
+
+    def __call__(self, x):
+        if isinstance(x, str) or not math.isfinite(x) or not x:
+            return x
+        a = abs(x)
+        if not (self.lo <= a < self.hi):
+            e = math.floor(math.log10(a))
+            self.lo, self.hi = 10.0**e, 10.0 ** (e + 1)
+            self.digits = -e + (self.n - 1) or None  # digits=None => 12 instead of 12.0
+            # '%.*f' rounds like round(), str() of a float below 1e-4 would use exponent notation
+            fixed = self.digits and self.digits > 0 and e >= -4
+            self.fmt = "%%.%df" % self.digits if fixed else None
+        if self.fmt and type(x) is float:
+            # same as str(round(x, digits)), about twice as fast
+            s = (self.fmt % x).rstrip("0")
+            return s + "0" if s[-1] == "." else s
+        return str(round(x, self.digits))
+
+
+class SampleEncoder:
+    """
+    Publishes the samples of one device with one message per value, like publish_sample(), publish_cell_voltages()
+    and publish_temperatures() do. Topics and the rounding of each value are prepared once (and when the number of
+    cells or temperature sensors grows) instead of on every publish.
+    """
+
+    def __init__(self, device_topic: str):
+        self.device_topic = device_topic
+        self._fields = [
+            (f"{device_topic}/{k}", k, d["field"], _Rounder(d.get("precision", 5)))
+            for k, d in sample_desc.items()
+        ]
+        self._switches: Dict[str, str] = {}
+        self._cells = []
+        self._cell_stats = [(f"{device_topic}/{k}", k) for k in CELL_STATS]
+        self._temps = []
+        self._meters: Dict[str, tuple] = {}
+
+    def _topic(self, key):
+        return f"{self.device_topic}/{key}", key
+
+    def publish_sample(self, client, sample: BmsSample):
+        for topic, k, field, rounder in self._fields:
+            value = rounder(getattr(sample, field))
+            mqtt_single_out(client, topic, value, deadband=deadband_for(k))
+
+        if sample.switches:
+            for switch_name, switch_state in sample.switches.items():
+                topic = self._switches.get(switch_name)
+                if topic is None:
+                    topic = f"{self.device_topic}/switch/{switch_name}"
+                    self._switches[switch_name] = topic
+                mqtt_single_out(client, topic, "ON" if switch_state else "OFF")
+
+    def publish_cell_voltages(self, client, voltages):
+        if not voltages:
+            return
+
+        while len(self._cells) < len(voltages):
+            self._cells.append(self._topic(f"cell_voltages/{len(self._cells) + 1}"))
+
+        for (topic, k), v in zip(self._cells, voltages):
+            mqtt_single_out(client, topic, v / 1000, deadband=deadband_for(k))
+        for (topic, k), v in zip(self._cell_stats, cell_stats(voltages)):
+            mqtt_single_out(client, topic, v, deadband=deadband_for(k))
+
+    def publish_temperatures(self, client, temperatures):
+        while len(self._temps) < len(temperatures):
+            self._temps.append((*self._topic(f"temperatures/{len(self._temps) + 1}"), _Rounder(4)))
+
+        for (topic, k, rounder), t in zip(self._temps, temperatures):
+            mqtt_single_out(client, topic, rounder(t), deadband=deadband_for(k))
+
+    def publish_meters(self, client, meters):
+        for name, reading in meters:
+            m = self._meters.get(name)
+            if m is None:
+                m = self._meters[name] = (*self._topic(f"meter/{name}"), _Rounder(4))
+            topic, k, rounder = m
+            mqtt_single_out(client, topic, rounder(reading), deadband=deadband_for(k))
+
+
+def publish_json_state(client, device_topic, sample: BmsSample, voltages, temperatures, meters):
+    """
+    Publish sample, cell voltages, temperatures and meters as one JSON document to `<device_topic>/state`, instead of
+    one message per value. Keys are the topic names of the per-value messages (e.g. "soc/current",
+    "cell_voltages/3"), Home Assistant extracts them with `value_template`.
+    Switch states keep their own topics, because they are also published after a switch was set.
+    """
+    state = {
+        k: round_to_n_value(getattr(sample, d["field"]), d.get("precision", 5))
+        for k, d in sample_desc.items()
+    }
+
+    if sample.switches:
+        for switch_name, switch_state in sample.switches.items():
+            topic = f"{device_topic}/switch/{switch_name}"
+            mqtt_single_out(client, topic, "ON" if switch_state else "OFF")
+
+    if voltages:
+        state.update(cell_voltage_values(voltages))
+
+    for i in range(0, len(temperatures)):
+        state[f"temperatures/{i + 1}"] = round_to_n_value(temperatures[i], 4)
+
+    for name, reading in meters:
+        state[f"meter/{name}"] = round_to_n_value(reading, 4)
+
+    remove_none_values(state)
+
+    # the document is published if any value exceeds its deadband
+    topic = f"{device_topic}/state"
+    last = _last_states.get(topic)
+    if last and (time.time() - last[0]) < _heartbeat and not _state_changed(last[1], state):
+        global num_suppressed
+        num_suppressed += 1
+        return
+
+    if mqtt_single_out(client, topic, json.dumps(state, separators=(",", ":"))) is not False:
+        _last_states[topic] = time.time(), state
+
+
+_last_states = {}
+
+
+def _state_changed(last: dict, state: dict) -> bool:
+    if last.keys() != state.keys():
+        return True
+    for k, v in state.items():
+        if v != last[k]:
+            db = deadband_for(k)
+            if db is None or db.exceeded(last[k], v):
+                return True
+    return False
 
 
 def publish_hass_discovery(
@@ -308,9 +553,41 @@ def publish_hass_discovery(
     num_cells,
     num_temp_sensors,
     device_info: DeviceInfo = None,
+    json_state=False,
 ):
+    """
+    Publish the Home Assistant discovery config of all entities of a device. Returns right away if the arguments are
+    the same as in the last call, otherwise only config messages whose content changed are sent. After a Home
+    Assistant restart (see subscribe_hass_status()) everything is sent again.
+
+    :param json_state: entities read their values from the JSON document published by publish_json_state()
+    """
+    fields = tuple(
+        k for k, d in sample_desc.items() if not is_none_or_nan(getattr(sample, d["field"]))
+    )
+    switches = tuple(sample.switches.keys()) if sample.switches else ()
+    inputs = (
+        expire_after_seconds,
+        fields,
+        num_cells,
+        num_temp_sensors,
+        str(device_info),
+        json_state,
+        switches,
+    )
+    if _discovery_inputs.get(device_topic) == inputs:
+        return
+
     discovery_msg = {}
 
+    def state_source(k):
+        if json_state:
+            return {
+                "state_topic": f"{device_topic}/state",
+                "value_template": "{{ value_json['%s'] }}" % k,
+            }
+        return {"state_topic": f"{device_topic}/{k}"}
+
     device_json = {
         "identifiers": [(device_info and device_info.sn) or device_topic],
         # "manufacturer": device_topic,  # Daly
@@ -330,7 +607,7 @@ def publish_hass_discovery(
             "state_class": state_class or None,
             "unit_of_measurement": unit,
             # "json_attributes_topic": f"{device_topic}/{k}",
-            "state_topic": f"{device_topic}/{k}",
+            **state_source(k),
             "expire_after": expire_after_seconds,
             "device": device_json,
         }
@@ -342,16 +619,16 @@ def publish_hass_discovery(
             f"homeassistant/sensor/{device_topic}/_{k.replace('/', '_')}/config"
         ] = dm
 
-    for k, d in sample_desc.items():
-        if not is_none_or_nan(getattr(sample, d["field"])):
-            _hass_discovery(
-                k,
-                d["device_class"],
-                state_class=d["state_class"],
-                unit=d["unit_of_measurement"],
-                icon=d.get("icon", None),
-                name=d["field"],
-            )
+    for k in fields:
+        d = sample_desc[k]
+        _hass_discovery(
+            k,
+            d["device_class"],
+            state_class=d["state_class"],
+            unit=d["unit_of_measurement"],
+            icon=d.get("icon", None),
+            name=d["field"],
+        )
 
     for i in range(0, num_cells):
         k = "cell_voltages/%d" % (i + 1)
@@ -394,7 +671,6 @@ def publish_hass_discovery(
     for name, m in meters.items():
         _hass_discovery("meter/%s" % name, **m, name=name.replace("_", " ") + " meter")
 
-    switches = sample.switches and sample.switches.keys()
     if switches:
         for switch_name in switches:
             discovery_msg[
@@ -423,22 +699,58 @@ def publish_hass_discovery(
                 "command_topic": f"homeassistant/switch/{device_topic}/{switch_name}/set",
             }
 
+    published = True
     for topic, data in discovery_msg.items():
-        mqtt_single_out(client, topic, json.dumps(data))
+        payload = json.dumps(data)
+        digest = hashlib.sha1(payload.encode()).digest()
+        if _discovery_hashes.get(topic) == digest:
+            continue
+        _last_values.pop(topic, None)  # always send, even if mqtt_single_out() sent the same payload recently
+        if mqtt_single_out(client, topic, payload) is False:
+            published = False
+        else:
+            _discovery_hashes[topic] = digest
+
+    if published:
+        _discovery_inputs[device_topic] = inputs
+
+
+# device topic -> arguments of the last publish_hass_discovery() call, config topic -> hash of the last payload
+_discovery_inputs: Dict[str, tuple] = {}
+_discovery_hashes: Dict[str, bytes] = {}
+
+
+def republish_hass_discovery():
+    _discovery_inputs.clear()
+    _discovery_hashes.clear()
+
+
+def subscribe_hass_status(mqtt_client: paho.Client, topic="homeassistant/status"):
+    """
+    Home Assistant publishes its birth message `online` when it (re-)connects to the broker. Discovery is then sent
+    again with the next sample of each device, so entities are restored after a Home Assistant restart.
+    """
+
+    async def on_status(payload):
+        if payload == "online":
+            logger.info("Home Assistant is online, re-publishing discovery")
+            republish_hass_discovery()
+
+    logger.info("subscribe %s", topic)
+    mqtt_client.subscribe(topic, qos=1)
+    _switch_callbacks[topic] = on_status
 
 
 _switch_callbacks = {}
-_message_queue = queue.Queue()
+_action_tasks = set()
 
 
-async def mqtt_process_action_queue():
-    while not _message_queue.empty():
-        callback, arg = _message_queue.get(block=False)
-        try:
-            await callback(arg)
-        except Exception as e:
-            logger.error("exception in action callback: %s", e)
-            logger.error("Stack: %s", traceback.format_exc())
+async def _run_action(callback, arg):
+    try:
+        await callback(arg)
+    except Exception as e:
+        logger.error("exception in action callback: %s", e)
+        logger.error("Stack: %s", traceback.format_exc())
 
 
 def subscribe_switches(mqtt_client: paho.Client, device_topic, bms: BtBms, switches):
@@ -459,12 +771,43 @@ def subscribe_switches(mqtt_client: paho.Client, device_topic, bms: BtBms, switc
         )
 
 
+def subscribe_trace(mqtt_client: paho.Client, device_topic, bms: BtBms):
+    """
+    Control the frame trace of a BMS at runtime with messages to `<device_topic>/trace/set`:
+    `on` records all frames, a number N records one in N frames, `off` stops recording and `dump` logs the recorded
+    frames.
+    """
+
+    async def set_trace(cmd: str):
+        cmd = cmd.strip().lower()
+        if cmd == "dump":
+            logger.info("%s %s:\n%s", bms.name, bms.trace, "\n".join(bms.trace.dump()))
+            return
+        if cmd in {"off", "0"}:
+            bms.trace.disable()
+        elif cmd == "on":
+            bms.trace.enable()
+        else:
+            bms.trace.enable(every=int(cmd))
+        logger.info("%s %s", bms.name, bms.trace)
+
+    topic = f"{device_topic}/trace/set"
+    logger.info("subscribe %s", topic)
+    mqtt_client.subscribe(topic, qos=2)
+    _switch_callbacks[topic] = set_trace
+
+
 def mqtt_message_handler(client, userdata, message: paho.MQTTMessage):
+    """
+    Called on the event loop by AsyncioMqttClient, runs the callback of the topic in a task
+    """
     payload = message.payload.decode("utf-8")
     logger.info("received msg %s: %s", message.topic, payload)
     callback = _switch_callbacks.get(message.topic, None)
     if callback:
-        _message_queue.put((callback, payload))
+        task = asyncio.ensure_future(_run_action(callback, payload))
+        _action_tasks.add(task)  # keep a reference until done
+        task.add_done_callback(_action_tasks.discard)
     else:
         logger.warning("No callback for topic %s (payload %s)", message.topic, payload)
 
@@ -0,0 +1,739 @@
+"""
+Micro benchmarks of the BMS data hot paths. Each benchmark checks that the optimized code produces the same results
+as the reference implementation it replaced.
+
+Run from the repository root:
+
+    python -m tools.bench
+
+"""
+import asyncio
+import copy
+import math
+import sys
+import time
+import timeit
+import tracemalloc
+
+from batmon.bmslib.bms import BmsSample
+
+
+def timed(fn, number):
+    """
+    :return: best time per call in us
+    """
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def report(name, t_ref, t_opt):
+    print("%-24s ref %8.2fus   opt %8.2fus   speedup %.2fx" % (name, t_ref, t_opt, t_ref / t_opt))
+
+
+def run_sync(coro):
+    """
+    Run a coroutine that never suspends, without the overhead of an event loop
+    """
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError("coroutine suspended")
+
+
+def sample_fields(sample: BmsSample):
+    # nan != nan, compare by repr
+    return {k: repr(getattr(sample, k)) for k in BmsSample.__slots__ if k != "timestamp"}
+
+
+# BmsSample
+
+
+class BmsSampleRef:
+    # BmsSample before __slots__
+    def __init__(
+        self,
+        voltage,
+        current,
+        power=math.nan,
+        charge=math.nan,
+        capacity=math.nan,
+        cycle_capacity=math.nan,
+        num_cycles=math.nan,
+        soc=math.nan,
+        balance_current=math.nan,
+        temperatures=None,
+        mos_temperature=math.nan,
+        switches=None,
+        uptime=math.nan,
+        timestamp=None,
+    ):
+        self.voltage = voltage
+        self.current = current or 0
+        self._power = power
+        self.balance_current = balance_current
+        if capacity > 0 and (math.isnan(soc) or (isinstance(soc, int) and charge > 0)):
+            soc = round(charge / capacity * 100, 2)
+        elif math.isnan(capacity) and soc > 0.2:
+            capacity = round(charge / soc * 100)
+        assert math.isfinite(soc)
+        self.charge = charge
+        self.capacity = capacity
+        self.soc = soc
+        self.cycle_capacity = cycle_capacity
+        self.num_cycles = num_cycles
+        self.temperatures = temperatures
+        self.mos_temperature = mos_temperature
+        self.switches = switches
+        self.uptime = uptime
+        self.timestamp = timestamp or time.time()
+        if switches:
+            assert all(map(lambda x: isinstance(x, bool), switches.values()))
+
+    @property
+    def power(self):
+        return (self.voltage * self.current) if math.isnan(self._power) else self._power
+
+    def __str__(self):
+        return (
+            "BmsSampl(%(soc).1f%%,U=%(voltage).1fV,I=%(current).2fA,P=%(power).0fW,q=%(charge).1fAh/%(capacity).0f,mos=%(mos_temperature).1f°C)"
+            % {**self.__dict__, "power": self.power}
+        )
+
+    def invert_current(self):
+        return self.multiply_current(-1)
+
+    def multiply_current(self, x):
+        res = copy.copy(self)
+        if res.current != 0:
+            res.current *= x
+        if not math.isnan(res._power) and res._power != 0:
+            res._power *= x
+        return res
+
+
+def bench_sample():
+    """
+    One sampling tick (1 Hz) of 50 BMSs: construct the sample, add it to a group, apply invert_current and the
+    current correction factor, keep it for publishing and log it.
+    """
+    num_bms = 50
+
+    def make(cls, i):
+        return cls(
+            voltage=26.5 + i * 0.01,
+            current=-12.2,
+            charge=181.0,
+            capacity=280.0,
+            soc=65,
+            num_cycles=7,
+            temperatures=[22.0, 23.0],
+            mos_temperature=28.3,
+            switches=dict(charge=True, discharge=True),
+            uptime=1000.0,
+        )
+
+    def tick_ref(invert, factor, group, records):
+        # sampler before the slotted sample
+        for i in range(num_bms):
+            sample = make(BmsSampleRef, i)
+            group[i] = copy.copy(sample)
+            if invert:
+                sample = sample.invert_current()
+            if factor and factor != 1:
+                sample = sample.multiply_current(factor)
+            records[i] = copy.copy(sample)
+            str(sample)
+
+    def tick_opt(invert, factor, group, records):
+        current_factor = (-1 if invert else 1) * (factor or 1)
+        for i in range(num_bms):
+            sample = make(BmsSample, i)
+            group[i] = sample
+            sample = sample.multiply_current(current_factor)
+            records[i] = sample
+            str(sample)
+
+    for invert, factor in ((False, 1), (True, 1.02)):
+        tr = [{}, {}]
+        to = [{}, {}]
+        tick_ref(invert, factor, *tr)
+        tick_opt(invert, factor, *to)
+        assert str(tr[1][3]) == str(to[1][3]) and str(tr[0][3]) == str(to[0][3])
+
+        name = "sample tick 50 bms" + (" inv,corr" if invert else "")
+        report(
+            name,
+            timed(lambda: tick_ref(invert, factor, *tr), 200),
+            timed(lambda: tick_opt(invert, factor, *to), 200),
+        )
+
+        def retained(tick):
+            # memory held by the group snapshots and publish records of one tick
+            group, records = {}, {}
+            tracemalloc.start()
+            tick(invert, factor, group, records)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return size
+
+        print(
+            "%-24s ref %8dB    opt %8dB    peak alloc/tick ref %dB opt %dB"
+            % (
+                name + " mem",
+                retained(tick_ref),
+                retained(tick_opt),
+                transient_alloc(lambda: tick_ref(invert, factor, *tr), 20),
+                transient_alloc(lambda: tick_opt(invert, factor, *to), 20),
+            )
+        )
+
+
+class MqttClientStub:
+    """
+    Records published messages
+    """
+
+    _info = None
+
+    def __init__(self):
+        self.messages = []
+        if MqttClientStub._info is None:
+            import paho.mqtt.client as paho
+
+            MqttClientStub._info = paho.MQTTMessageInfo(0)
+
+    def publish(self, topic, payload, retain=False):
+        self.messages.append((topic, payload))
+        return self._info
+
+
+def bench_publish():
+    """
+    Publish a 16 cell sample with per-value messages and as one JSON document
+    """
+    import json
+
+    from batmon import mqtt_util
+
+    sample = BmsSample(
+        voltage=53.21,
+        current=-12.2,
+        charge=181.0,
+        capacity=280.0,
+        num_cycles=7,
+        temperatures=[22.0, 23.5],
+        mos_temperature=28.3,
+        switches=dict(charge=True, discharge=True),
+        uptime=1000.0,
+        balance_current=0.02,
+    )
+    voltages = [3300 + i * 3 for i in range(16)]
+    temperatures = [22.0, 23.5]
+    meters = [
+        ("total_energy", 12.345678),
+        ("total_energy_charge", 20.1),
+        ("total_energy_discharge", 7.75),
+        ("total_charge", 300.0),
+        ("total_cycles", 1.25),
+        ("total_abs_diff_charge", 301.5),
+    ]
+
+    def publish_topics(client):
+        mqtt_util._last_values.clear()
+        mqtt_util.publish_sample(client, "bat", sample)
+        for name, reading in meters:
+            mqtt_util.mqtt_single_out(client, f"bat/meter/{name}", mqtt_util.round_to_n(reading, 4))
+        mqtt_util.publish_cell_voltages(client, "bat", voltages)
+        mqtt_util.publish_temperatures(client, "bat", temperatures)
+
+    def publish_json(client):
+        mqtt_util._last_values.clear()
+        mqtt_util._last_states.clear()
+        mqtt_util.publish_json_state(client, "bat", sample, voltages, temperatures, meters)
+
+    c_topics, c_json = MqttClientStub(), MqttClientStub()
+    publish_topics(c_topics)
+    publish_json(c_json)
+
+    # same values, keyed by topic
+    topics = {t[4:]: str(v) for t, v in c_topics.messages if str(v) != "nan"}
+    # switch states keep their own topics in json mode
+    state = {t[4:]: str(v) for t, v in c_json.messages if t != "bat/state"}
+    doc = next(v for t, v in c_json.messages if t == "bat/state")
+    state.update((k, str(v)) for k, v in json.loads(doc).items())
+    assert topics == state, set(topics.items()) ^ set(state.items())
+
+    report(
+        "publish 16 cells",
+        timed(lambda: publish_topics(MqttClientStub()), 2000),
+        timed(lambda: publish_json(MqttClientStub()), 2000),
+    )
+
+    def size(messages):
+        return sum(len(t) + len(str(v)) for t, v in messages)
+
+    print(
+        "%-24s topics %d msgs %dB   json %d msgs %dB"
+        % (
+            "publish messages",
+            len(c_topics.messages),
+            size(c_topics.messages),
+            len(c_json.messages),
+            size(c_json.messages),
+        )
+    )
+
+
+def bench_encoder():
+    """
+    Publish 100 16 cell samples with the module functions and a SampleEncoder
+    """
+    import random
+
+    from batmon import mqtt_util
+
+    rnd = random.Random(1)
+    records = []
+    for i in range(100):
+        current = rnd.uniform(-120, 120)
+        sample = BmsSample(
+            voltage=53.2 + rnd.gauss(0, 0.5),
+            current=current,
+            power=53.2 * current,
+            charge=181.0 - i * 0.3,
+            capacity=280.0,
+            num_cycles=7,
+            mos_temperature=28.3 + rnd.gauss(0, 1),
+            switches=dict(charge=True, discharge=i % 10 != 0),
+            balance_current=rnd.choice((0, 0.02, 0.5)),
+        )
+        voltages = [3300 + rnd.randint(-30, 30) for _ in range(16)]
+        temperatures = [rnd.uniform(-10, 40) for _ in range(4)]
+        meters = [("total_energy", 12.345678 + i), ("total_charge", 300.0 + i * 0.1)]
+        records.append((sample, voltages, temperatures, meters))
+
+    def publish_ref(client):
+        mqtt_util._last_values.clear()
+        for sample, voltages, temperatures, meters in records:
+            mqtt_util.publish_sample(client, "bat", sample)
+            for name, reading in meters:
+                mqtt_util.mqtt_single_out(client, f"bat/meter/{name}", mqtt_util.round_to_n(reading, 4))
+            mqtt_util.publish_cell_voltages(client, "bat", voltages)
+            mqtt_util.publish_temperatures(client, "bat", temperatures)
+        return client.messages
+
+    encoder = mqtt_util.SampleEncoder("bat")
+
+    def publish_opt(client):
+        mqtt_util._last_values.clear()
+        for sample, voltages, temperatures, meters in records:
+            encoder.publish_sample(client, sample)
+            encoder.publish_meters(client, meters)
+            encoder.publish_cell_voltages(client, voltages)
+            encoder.publish_temperatures(client, temperatures)
+        return client.messages
+
+    mqtt_util.set_deadbands({})
+    assert publish_ref(MqttClientStub()) == publish_opt(MqttClientStub())
+
+    report(
+        "encode 100x16 cells",
+        timed(lambda: publish_ref(MqttClientStub()), 20),
+        timed(lambda: publish_opt(MqttClientStub()), 20),
+    )
+
+
+def bench_discovery():
+    """
+    Home Assistant discovery of a 16 cell BMS, sent every time vs. cached by content
+    """
+    from batmon import mqtt_util
+
+    sample = BmsSample(
+        voltage=53.21,
+        current=-12.2,
+        charge=181.0,
+        capacity=280.0,
+        num_cycles=7,
+        mos_temperature=28.3,
+        switches=dict(charge=True, discharge=True),
+    )
+
+    def discovery(client, num_cells=16):
+        mqtt_util.publish_hass_discovery(
+            client, "bat", 20, sample, num_cells=num_cells, num_temp_sensors=2
+        )
+        return client.messages
+
+    def discovery_ref(client):
+        mqtt_util.republish_hass_discovery()
+        mqtt_util._last_values.clear()
+        return discovery(client)
+
+    everything = discovery_ref(MqttClientStub())
+    assert discovery(MqttClientStub()) == []
+    assert len(discovery(MqttClientStub(), num_cells=17)) == 1  # new cell
+    mqtt_util.republish_hass_discovery()  # birth message
+    assert len(discovery(MqttClientStub())) == len(everything)
+
+    report(
+        "discovery %d entities" % len(everything),
+        timed(lambda: discovery_ref(MqttClientStub()), 200),
+        timed(lambda: discovery(MqttClientStub()), 200),
+    )
+
+
+def bench_deadband():
+    """
+    Publish 600 noisy 16 cell samples with and without deadbands, within one heartbeat
+    """
+    import random
+
+    from batmon import mqtt_util
+
+    rnd = random.Random(1)
+    samples = []
+    for i in range(600):
+        current = -12.2 + rnd.gauss(0, 0.05)
+        samples.append(
+            (
+                BmsSample(
+                    voltage=round(53.2 + rnd.gauss(0, 0.01), 2),
+                    current=round(current, 2),
+                    power=round(53.2 * current, 1),
+                    charge=181.0 - i * 0.003,
+                    capacity=280.0,
+                    temperatures=[22.0, 23.5],
+                ),
+                [3300 + i // 100 + j * 3 + rnd.choice((-1, 0, 0, 1)) for j in range(16)],
+            )
+        )
+    deadbands = mqtt_util.parse_deadbands(
+        "soc/total_voltage=0.05,soc/current=0.2,soc/power=2%,soc/soc_percent=0.5,soc/cycle_capacity=1%,"
+        "mosfet_status/capacity_ah=0.5,cell_voltages=0.002,temperatures=0.5"
+    )
+
+    def publish(client, json_state):
+        mqtt_util._last_values.clear()
+        mqtt_util._last_states.clear()
+        for sample, voltages in samples:
+            if json_state:
+                mqtt_util.publish_json_state(client, "bat", sample, voltages, sample.temperatures, [])
+            else:
+                mqtt_util.publish_sample(client, "bat", sample)
+                mqtt_util.publish_cell_voltages(client, "bat", voltages)
+                mqtt_util.publish_temperatures(client, "bat", sample.temperatures)
+        return len(client.messages)
+
+    for json_state in (False, True):
+        mqtt_util.set_deadbands({})
+        n_ref = publish(MqttClientStub(), json_state)
+        mqtt_util.set_deadbands(deadbands)
+        n_opt = publish(MqttClientStub(), json_state)
+        print(
+            "%-24s ref %6d msgs   opt %6d msgs   %.1f%% suppressed"
+            % ("deadband " + ("json" if json_state else "topics"), n_ref, n_opt, 100 * (1 - n_opt / n_ref))
+        )
+    mqtt_util.set_deadbands({})
+
+
+# JK
+
+
+def jk_decode_sample_ref(buf, buf_set) -> BmsSample:
+    # JKBt._decode_sample before the struct decoder
+    is_new_11fw = buf[189] == 0x00 and buf[189 + 32] > 0
+    offset = 0
+    if is_new_11fw:
+        offset = 32
+
+    i16 = lambda i: int.from_bytes(buf[i : (i + 2)], byteorder="little", signed=True)
+    u32 = lambda i: int.from_bytes(buf[i : (i + 4)], byteorder="little", signed=False)
+    f32u = lambda i: u32(i) * 1e-3
+    f32s = lambda i: int.from_bytes(buf[i : (i + 4)], byteorder="little", signed=True) * 1e-3
+
+    temp = lambda x: float("nan") if x == -2000 else (x / 10)
+
+    return BmsSample(
+        voltage=f32u(118 + offset),
+        current=-f32s(126 + offset),
+        soc=buf[141 + offset],
+        cycle_capacity=f32u(154 + offset),
+        capacity=f32u(146 + offset),
+        charge=f32u(142 + offset),
+        temperatures=[temp(i16(130 + offset)), temp(i16(132 + offset))],
+        mos_temperature=i16(134 + offset) / 10,
+        balance_current=i16(138 + offset) / 1000,
+        num_cycles=u32(150 + offset),
+        switches=dict(
+            charge=bool(buf_set[118]),
+            discharge=bool(buf_set[122]),
+        ),
+        uptime=float(u32(162 + offset)),
+    )
+
+
+def jk_voltages_ref(buf, num_cells):
+    return [int.from_bytes(buf[(6 + i * 2) : (6 + i * 2 + 2)], byteorder="little") for i in range(num_cells)]
+
+
+def bench_jk_decode():
+    from batmon.bmslib.dummy import JKDummy
+    from batmon.bmslib.jikong import JKBt
+
+    for is_new_11x in (False, True):
+        msg_settings, msg_sample = (bytearray(m) for m in JKDummy(is_new_11x=is_new_11x).MSGS)
+        bms = JKBt("test_jk", name="bench")
+        bms._resp_table[0x01] = msg_settings
+        bms._resp_table[0x02] = msg_sample
+        bms.num_cells = msg_settings[114]
+
+        assert sample_fields(bms._decode_sample(msg_sample)) == sample_fields(
+            jk_decode_sample_ref(msg_sample, msg_settings)
+        )
+        s = bms._decode_sample(msg_sample)
+        assert bms._decode_current(msg_sample) == (s.voltage, s.current)
+
+        fw = "11.x" if is_new_11x else "10.x"
+        report(
+            "jk decode_sample " + fw,
+            timed(lambda: jk_decode_sample_ref(msg_sample, msg_settings), 20000),
+            timed(lambda: bms._decode_sample(msg_sample), 20000),
+        )
+
+        assert run_sync(bms.fetch_voltages()) == jk_voltages_ref(msg_sample, bms.num_cells)
+        report(
+            "jk fetch_voltages " + fw,
+            timed(lambda: jk_voltages_ref(msg_sample, bms.num_cells), 20000),
+            timed(lambda: run_sync(bms.fetch_voltages()), 20000),
+        )
+
+
+class JKFramesRef:
+    # JKBt._notification_handler and _decode_msg before the FrameAssembler
+    HEADER = bytes([0x55, 0xAA, 0xEB, 0x90])
+
+    def __init__(self, logger):
+        from batmon.bmslib import RequestCorrelator
+
+        self.logger = logger
+        self._buffer = bytearray()
+        self._resp_table = {}
+        self._requests = RequestCorrelator()
+
+    def _buffer_crc_check(self):
+        from batmon.bmslib.jikong import calc_crc
+
+        crc_comp = calc_crc(self._buffer[0:299])
+        crc_expected = self._buffer[299]
+        if crc_comp != crc_expected:
+            self.logger.debug("crc check failed, %s != %s, %s", crc_comp, crc_expected, self._buffer)
+        return crc_comp == crc_expected
+
+    def notification_handler(self, sender, data):
+        from batmon.bmslib.jikong import to_hex_str
+
+        if data[0:4] == self.HEADER:
+            self.logger.debug("header, clear buf %s", self._buffer)
+            self._buffer.clear()
+        self._buffer += data
+        self.logger.debug("bms msg(%d) (buf%d): %s\n", len(data), len(self._buffer), to_hex_str(data))
+        if len(self._buffer) >= 300:
+            crc_ok = self._buffer_crc_check()
+            if not crc_ok and self.HEADER in self._buffer:
+                idx = self._buffer.index(self.HEADER)
+                self._buffer = self._buffer[idx:]
+                crc_ok = self._buffer_crc_check()
+            if crc_ok:
+                self.decode_msg(bytearray(self._buffer))
+            self._buffer.clear()
+
+    def decode_msg(self, buf):
+        resp_type = buf[4]
+        self.logger.debug("got response %d (len%d)", resp_type, len(buf))
+        self._resp_table[resp_type] = buf
+        self._requests.set_result(resp_type, self._buffer[:])
+
+
+def transient_alloc(fn, number=100):
+    """
+    :return: peak of memory allocated during a call, in bytes
+    """
+    fn()
+    tracemalloc.start()
+    peak = 0
+    for _ in range(number):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    return peak
+
+
+def bench_jk_frames():
+    from batmon.bmslib.dummy import JKDummy
+    from batmon.bmslib.jikong import JKBt
+
+    # the BMS sends frames in notifications of up to MTU size
+    mtu = 128
+    fragments = [
+        msg[i : i + mtu] for msg in JKDummy().MSGS for i in range(0, len(msg), mtu)
+    ]
+
+    bms = JKBt("test_jk", name="bench")
+    bms.logger.setLevel("INFO")
+    ref = JKFramesRef(bms.logger)
+
+    def feed_ref():
+        for f in fragments:
+            ref.notification_handler(None, f)
+
+    def feed_opt():
+        for f in fragments:
+            bms._notification_handler(None, f)
+
+    # garbage before the header
+    feed_ref()
+    feed_opt()
+    for f in (b"\x01\x02" + bytes(fragments[0][:20]), *fragments[:3]):
+        ref.notification_handler(None, f)
+        bms._notification_handler(None, f)
+
+    assert bms.debug_data() == {k: bytes(v) for k, v in ref._resp_table.items()}
+
+    num_frames = len(JKDummy().MSGS)
+    report(
+        "jk frames (per frame)",
+        timed(feed_ref, 2000) / num_frames,
+        timed(feed_opt, 2000) / num_frames,
+    )
+    print(
+        "%-24s ref %8dB    opt %8dB"
+        % ("jk frames peak alloc", transient_alloc(feed_ref), transient_alloc(feed_opt))
+    )
+
+
+# Daly
+
+
+async def daly_sample_ref(bms):
+    # full sample before pipelining, one round trip per command
+    status = await bms._fetch_status()
+    sample = await bms.fetch_soc(
+        sample_kwargs=dict(
+            charge=status["capacity_ah"],
+            switches=dict(
+                charge=bool(status["charging_mosfet"]),
+                discharge=bool(status["discharging_mosfet"]),
+            ),
+        )
+    )
+    num_cells, num_temps = bms._states["num_cells"], bms._states["num_temps"]
+    voltages = bms._parse_voltages(await bms._q(0x95, bms._num_voltage_responses(num_cells)), num_cells)
+    temperatures = bms._parse_temperatures(
+        await bms._q(0x96, bms._num_temperature_responses(num_temps)), num_temps
+    )
+    return sample, voltages, temperatures
+
+
+async def daly_sample(bms):
+    sample = await bms.fetch()
+    return sample, await bms.fetch_voltages(), await bms.fetch_temperatures()
+
+
+def bench_daly_fetch():
+    from batmon.bmslib.daly import DalyBt
+
+    latency = 0.02  # BLE round trip
+
+    async def run():
+        bms = DalyBt("test_daly", name="bench")
+        bms.client._bms.latency = latency
+        await bms.connect()
+        await bms.fetch()  # read states
+
+        def result(r):
+            sample, voltages, temperatures = r
+            return sample_fields(sample), voltages, temperatures
+
+        assert result(await daly_sample_ref(bms)) == result(await daly_sample(bms))
+
+        async def timed_async(fn, number=10):
+            t = time.perf_counter()
+            for _ in range(number):
+                await fn(bms)
+            return (time.perf_counter() - t) / number * 1e3
+
+        t_ref = await timed_async(daly_sample_ref)
+        t_opt = await timed_async(daly_sample)
+        print(
+            "%-24s ref %8.1fms   opt %8.1fms   round trips %.1f -> %.1f"
+            % ("daly sample", t_ref, t_opt, t_ref / (latency * 1e3), t_opt / (latency * 1e3))
+        )
+
+    asyncio.run(run())
+
+
+# JBD
+
+
+def bench_jbd_fetch():
+    from batmon.bmslib.jbd import JbdBt
+
+    latency = 0.02  # BLE round trip
+
+    async def run():
+        bms = JbdBt("test_jbd", name="bench")
+        bms.client._bms.latency = latency
+        await bms.connect()
+
+        async def sample_ref():
+            # fetch() and fetch_voltages() before pipelining, one round trip each
+            resp = {0x03: await bms._q(0x03), 0x04: await bms._q(0x04)}
+            return resp[0x03], bms._parse_voltages(resp[0x04])
+
+        async def sample_opt():
+            return await bms.fetch(), await bms.fetch_voltages()
+
+        ref_info, ref_voltages = await sample_ref()
+        sample, voltages = await sample_opt()
+        assert voltages == ref_voltages
+        assert sample.voltage == int.from_bytes(ref_info[4:6], "big") / 100
+
+        async def timed_async(fn, number=10):
+            t = time.perf_counter()
+            for _ in range(number):
+                await fn()
+            return (time.perf_counter() - t) / number * 1e3
+
+        t_ref = await timed_async(sample_ref)
+        t_opt = await timed_async(sample_opt)
+        print(
+            "%-24s ref %8.1fms   opt %8.1fms   round trips %.1f -> %.1f"
+            % ("jbd sample", t_ref, t_opt, t_ref / (latency * 1e3), t_opt / (latency * 1e3))
+        )
+
+    asyncio.run(run())
+
+
+BENCHMARKS = dict(
+    sample=bench_sample,
+    publish=bench_publish,
+    encoder=bench_encoder,
+    discovery=bench_discovery,
+    deadband=bench_deadband,
+    jk_decode=bench_jk_decode,
+    jk_frames=bench_jk_frames,
+    daly_fetch=bench_daly_fetch,
+    jbd_fetch=bench_jbd_fetch,
+)
+
+
+def main(names):
+    for name in names or BENCHMARKS.keys():
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])